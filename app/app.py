@@ -47,6 +47,15 @@ def get_indexer(target_name: str):
         collection_name=collection_name)
 
 
+# Return registry of read-only indexers shared by all sessions, created once
+# per process, so each collection is loaded once instead of per session
+@st.cache_resource
+def indexer_registry():
+    from query.registry import IndexerRegistry
+
+    return IndexerRegistry(get_indexer)
+
+
 # Function for querying Taiwan law database
 def search_vector_store(
         prompt_input,
@@ -54,7 +63,11 @@ def search_vector_store(
         top_k: int = 10,
         chain_type: str = 'stuff',) -> str:
     from query import qa
-    from util.openai import chatter
+    from util.normalize import normalize
+    from util.openai import answer_cache, chatter
+
+    # normalize query the same way as documents
+    prompt_input = normalize(prompt_input)
 
     # create retrieval qa
     rqa = qa.EmbeddingsRetrievalQA(
@@ -63,7 +76,9 @@ def search_vector_store(
         retriever=indexer.as_multiquery_retriever(
             top_k=top_k,
         ),
-        return_source_documents=True)
+        return_source_documents=True,
+        answer_cache=answer_cache(),
+        indexer=indexer)
 
     search_results = rqa.query({"query": prompt_input})
 
@@ -73,16 +88,14 @@ def search_vector_store(
     }
 
 
+# load shared indexer of selected target ahead of first query
 def handle_selectbox_change():
     if st.session_state.target_name == const.APP_QUERY_TARGET_LAW:
-        if "law_indexer" not in st.session_state.keys():
-            st.session_state.law_indexer = get_indexer('law')
+        indexer_registry().get('law')
     elif st.session_state.target_name == const.APP_QUERY_TARGET_INVESTIGATION:
-        if "investigation_indexer" not in st.session_state.keys():
-            st.session_state.investigation_indexer = get_indexer('investigation')
+        indexer_registry().get('investigation')
     elif st.session_state.target_name == const.APP_QUERY_TARGET_NEWS:
-        if "news_indexer" not in st.session_state.keys():
-            st.session_state.news_indexer = get_indexer('news')
+        indexer_registry().get('news')
 
 
 def login():
@@ -116,19 +129,19 @@ def login():
                     if st.session_state.target_name == const.APP_QUERY_TARGET_LAW:
                         result_set = search_vector_store(
                             prompt_input=query_input,
-                            indexer=st.session_state.law_indexer,
+                            indexer=indexer_registry().get('law'),
                             top_k=10,
                             chain_type='stuff')
                     elif st.session_state.target_name == const.APP_QUERY_TARGET_INVESTIGATION:
                         result_set = search_vector_store(
                             prompt_input=query_input,
-                            indexer=st.session_state.investigation_indexer,
+                            indexer=indexer_registry().get('investigation'),
                             top_k=5,
                             chain_type='refine')
                     elif st.session_state.target_name == const.APP_QUERY_TARGET_NEWS:
                         result_set = search_vector_store(
                             prompt_input=query_input,
-                            indexer=st.session_state.news_indexer,
+                            indexer=indexer_registry().get('news'),
                             top_k=5,
                             chain_type='refine')
                 except Exception as e:
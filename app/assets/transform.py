@@ -20,14 +20,29 @@
 # FileName,檔案名稱
 # FileURL,下載網址
 
+import os
+import re
+import glob
 import json
+import hashlib
 import logging
+from collections import deque
+from dataclasses import asdict
+from multiprocessing import Pool
+from typing import Iterable, Iterator, TextIO
 
-from dto.law import Law, LawCollection
+from dto.law import Law, article_id, category_shard
+from util.normalize import normalize
 
 # Get logger
 logger = logging.getLogger(__name__)
 
+# characters not allowed in shard file name
+_SHARD_FILENAME = re.compile(r'[\\/:*?"<>|＞\s]+')
+
+# whitespace allowed between JSON tokens
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
 
 def loader(src_filepath: str) -> list:
     with open(src_filepath, 'r', encoding='utf-8-sig') as f:
@@ -35,75 +50,432 @@ def loader(src_filepath: str) -> list:
     return data['Laws']
 
 
-# remove space, ├, ─, ┼, ┤, │
-def remove_space(text: str) -> str:
-    return text.replace(' ', '').replace('├', '').replace('─', '').replace('┼', '').replace('┤', '').replace('│', '')
+# A reader to decode JSON values one at a time from a text stream,
+# only the undecoded tail of the file is kept in memory
+class _JSONStreamReader:
+    def __init__(self, f: TextIO, buffer_size: int):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
 
+    # read more text into buffer and drop what has been consumed
+    def _read(self, size: int) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
 
-def transformer(
-        data: list,
-        allowed_category: list = []) -> LawCollection:
-    # a list of transformed law with data type Law, and exclude abandoned law
-    articles = LawCollection(data=[])
+    # skip whitespace and return the next character, or '' at end of file
+    def peek(self) -> str:
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read(self.buffer_size):
+                return ''
 
-    for law in data:
-        law_level = law['LawLevel']
-        law_name = law['LawName']
-        law_url = law['LawURL']
-        law_category = law['LawCategory']
-        # article['LawModifiedDate'] = law['LawModifiedDate']
-        # article['LawEffectiveDate'] = law['LawEffectiveDate']
-        # article['LawEffectiveNote'] = law['LawEffectiveNote']
-        law_abandon_note = law['LawAbandonNote']
-        # article['LawHasEngVersion'] = law['LawHasEngVersion']
-        # article['EngLawName'] = law['EngLawName']
-        # article['LawAttachements'] = law['LawAttachements']
-        # article['FileName'] = article['FileName']
-        # article['FileURL'] = article['FileURL']
-        # article['LawHistories'] = law['LawHistories']
-        # article['LawForeword'] = law['LawForeword']
-
-        if law_abandon_note:
+    # consume the expected structural character
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f'Expected {char!r} but found {found!r}')
+        self.pos += 1
+
+    # decode the next complete JSON value
+    def value(self):
+        self.peek()
+        size = self.buffer_size
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a value touching the end of buffer may be truncated, e.g. a number
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # grow read size for records larger than the buffer
+            self._read(size)
+            size *= 2
+
+
+# stream law records one at a time from open data in JSON format,
+# so memory is bounded by the largest law instead of the whole file
+def iter_loader(
+        src_filepath: str,
+        key: str = 'Laws',
+        buffer_size: int = 1 << 20) -> Iterator[dict]:
+    with open(src_filepath, 'r', encoding='utf-8-sig') as f:
+        reader = _JSONStreamReader(f, buffer_size)
+        reader.expect('{')
+        while reader.peek() != '}':
+            name = reader.value()
+            reader.expect(':')
+            if name != key:
+                # skip other top level fields, e.g. UpdateDate
+                reader.value()
+            else:
+                reader.expect('[')
+                if reader.peek() == ']':
+                    return
+                while True:
+                    yield reader.value()
+                    if reader.peek() == ']':
+                        return
+                    reader.expect(',')
+            if reader.peek() == ',':
+                reader.pos += 1
+    logger.warning(f'No {key} found in file {src_filepath}')
+
+
+# check if law is neither abandoned nor out of allowed category
+def is_allowed(
+        law: dict,
+        allowed_category: list = []) -> bool:
+    law_name = law['LawName']
+    law_category = law['LawCategory']
+    law_abandon_note = law['LawAbandonNote']
+
+    if law_abandon_note:
+        logger.debug(
+            f'Law {law_name}, {law_category} is abandoned with abandon note {law_abandon_note}, skip')
+        return False
+
+    if allowed_category:
+        allowed_category_found = False
+        for category in allowed_category:
+            if category in law_category:
+                allowed_category_found = True
+                break
+        if not allowed_category_found:
             logger.debug(
-                f'Law {law_name}, {law_category} is abandoned with abandon note {law_abandon_note}, skip')
+                f'Law {law_name}, {law_category} is not in allowed category, skip')
+            return False
+
+    return True
+
+
+# transform articles of a single law into a list of Law
+def transform_articles(law: dict) -> list[Law]:
+    law_level = law['LawLevel']
+    law_name = law['LawName']
+    law_url = law['LawURL']
+    law_category = law['LawCategory']
+    # article['LawModifiedDate'] = law['LawModifiedDate']
+    # article['LawEffectiveDate'] = law['LawEffectiveDate']
+    # article['LawEffectiveNote'] = law['LawEffectiveNote']
+    # article['LawHasEngVersion'] = law['LawHasEngVersion']
+    # article['EngLawName'] = law['EngLawName']
+    # article['LawAttachements'] = law['LawAttachements']
+    # article['FileName'] = article['FileName']
+    # article['FileURL'] = article['FileURL']
+    # article['LawHistories'] = law['LawHistories']
+    # article['LawForeword'] = law['LawForeword']
+
+    articles = []
+
+    # iterate through each article in each law
+    article_content_chapter = ""
+    for article in law['LawArticles']:
+        article_type = article['ArticleType']
+        if article_type == 'C':
+            article_content_chapter = article['ArticleContent']
             continue
+        if article_type == 'A':
+            article_no = article['ArticleNo']
+            article_content = article['ArticleContent']
 
-        if allowed_category:
-            allowed_category_found = False
-            for category in allowed_category:
-                if category in law_category:
-                    allowed_category_found = True
-                    break
-            if not allowed_category_found:
-                logger.debug(
-                    f'Law {law_name}, {law_category} is not in allowed category, skip')
-                continue
+        # normalize text and remove space
+        article_content_chapter = normalize(
+            article_content_chapter, remove_space=True)
+        article_no = normalize(article_no, remove_space=True)
+        article_content = normalize(article_content, remove_space=True)
 
-        # iterate through each article in each law
-        article_content_chapter = ""
-        for article in law['LawArticles']:
-            article_type = article['ArticleType']
-            if article_type == 'C':
-                article_content_chapter = article['ArticleContent']
-                continue
-            if article_type == 'A':
-                article_no = article['ArticleNo']
-                article_content = article['ArticleContent']
-
-            # remove space
-            article_content_chapter = remove_space(article_content_chapter)
-            article_no = remove_space(article_no)
-            article_content = remove_space(article_content)
-
-            law = Law(
-                LawLevel=law_level,
-                LawName=law_name,
-                LawURL=law_url,
-                LawCategory=law_category,
-                LawArticleChapter=article_content_chapter,
-                LawArticleNo=article_no,
-                LawArticleContent=article_content,
-            )
-            articles.data.append(law)
+        articles.append(Law(
+            LawLevel=law_level,
+            LawName=law_name,
+            LawURL=law_url,
+            LawCategory=law_category,
+            LawArticleChapter=article_content_chapter,
+            LawArticleNo=article_no,
+            LawArticleContent=article_content,
+        ))
 
     return articles
+
+
+# transform laws one at a time and write articles to writer as they are
+# produced, exclude abandoned law, return number of articles written
+def transformer(
+        data: Iterable[dict],
+        writer: 'JsonLinesWriter | ShardedJsonLinesWriter',
+        allowed_category: list = [],
+        manifest: 'TransformManifest' = None) -> int:
+    written = writer.count
+    for law in data:
+        if not is_allowed(law, allowed_category):
+            continue
+        articles = [asdict(article) for article in transform_articles(law)]
+        for article in articles:
+            writer.write(article)
+        if manifest is not None:
+            manifest.update(law['LawURL'], law.get('LawModifiedDate'), articles)
+
+    return writer.count - written
+
+
+# A writer to output transformed articles in JSON lines format,
+# one article per line, so articles are written as they are produced
+class JsonLinesWriter:
+    def __init__(self, dst_filepath: str):
+        self.dst_filepath = dst_filepath
+        self.count = 0
+        self.f = open(dst_filepath, 'w', encoding='utf-8')
+
+    def write(self, article: dict):
+        self.f.write(json.dumps(article, ensure_ascii=False))
+        self.f.write('\n')
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# A writer to partition transformed articles by LawCategory into shards in
+# JSON lines format, e.g. one shard per ministry, with a category index
+class ShardedJsonLinesWriter:
+    def __init__(
+            self,
+            dst_path: str,
+            name: str):
+        self.dst_path = dst_path
+        self.name = name
+        self.count = 0
+        self.writers = {}
+        self.shards = {}
+
+    def write(self, article: dict):
+        category = article['LawCategory']
+        key = category_shard(category)
+        writer = self.writers.get(key)
+        if writer is None:
+            filename = f'{self.name}.{_SHARD_FILENAME.sub("_", key)}.jsonl'
+            writer = self.writers[key] = JsonLinesWriter(
+                os.path.join(self.dst_path, filename))
+            self.shards[key] = {'file': filename, 'articles': 0, 'categories': {}}
+        writer.write(article)
+        shard = self.shards[key]
+        shard['articles'] += 1
+        shard['categories'][category] = shard['categories'].get(category, 0) + 1
+        self.count += 1
+
+    # close shards, remove stale shards of previous run and write category index
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+        filenames = {shard['file'] for shard in self.shards.values()}
+        stale = glob.glob(os.path.join(self.dst_path, f'{self.name}.*.jsonl'))
+        # monolithic output before partition
+        stale.append(os.path.join(self.dst_path, f'{self.name}.json'))
+        stale.append(os.path.join(self.dst_path, f'{self.name}.jsonl'))
+        for filepath in stale:
+            if os.path.exists(filepath) and os.path.basename(filepath) not in filenames:
+                logger.info(f'Removing stale transformed file {filepath}')
+                os.remove(filepath)
+
+        index_filepath = os.path.join(self.dst_path, f'{self.name}.categories')
+        with open(index_filepath, 'w', encoding='utf-8') as f:
+            json.dump({'shards': self.shards}, f, ensure_ascii=False, indent=4)
+        logger.info(
+            f'Written {self.count} articles into {len(self.shards)} shards with index {index_filepath}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # keep category index of previous run if transform failed
+        if exc_type is not None:
+            for writer in self.writers.values():
+                writer.close()
+            return
+        self.close()
+
+
+# worker function to transform a batch of laws in a child process,
+# return plain dict to keep pickling cheap, grouped by law
+def _transform_batch(laws: list[dict]) -> list[list[dict]]:
+    return [[asdict(article) for article in transform_articles(law)] for law in laws]
+
+
+# group records into lists of batch size
+def _batched(data: Iterable[dict], batch_size: int) -> Iterator[list[dict]]:
+    batch = []
+    for record in data:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# transform laws across a process pool and write articles to writer
+# in the original order, return number of articles written
+def parallel_transformer(
+        data: Iterable[dict],
+        writer: JsonLinesWriter | ShardedJsonLinesWriter,
+        allowed_category: list = [],
+        worker_count: int = None,
+        batch_size: int = 64,
+        manifest: 'TransformManifest' = None) -> int:
+    # determine number of worker by CPU count, and reserve one for main process
+    if not worker_count:
+        worker_count = max(os.cpu_count() - 1, 1)
+    logger.info(
+        f'Transforming with {worker_count} workers and batch size {batch_size}')
+
+    # filter in main process, so excluded laws are never sent to workers
+    allowed = (law for law in data if is_allowed(law, allowed_category))
+
+    def write(keys: list[tuple], result):
+        for (law_url, modified_date), articles in zip(keys, result.get()):
+            for article in articles:
+                writer.write(article)
+            if manifest is not None:
+                manifest.update(law_url, modified_date, articles)
+
+    written = writer.count
+    pending = deque()
+    with Pool(processes=worker_count) as pool:
+        for batch in _batched(allowed, batch_size):
+            keys = [(law['LawURL'], law.get('LawModifiedDate')) for law in batch]
+            pending.append(
+                (keys, pool.apply_async(_transform_batch, (batch, ))))
+            # bound batches in flight, so memory does not grow with input
+            while len(pending) >= worker_count * 2:
+                write(*pending.popleft())
+        while pending:
+            write(*pending.popleft())
+
+    return writer.count - written
+
+
+# A manifest of LawModifiedDate, LawCategory and article hashes of each law
+# from previous run, to emit only added, changed and removed articles as a
+# delta file, with category of previous run if an article is recategorized
+class TransformManifest:
+    # bump when transform output changes for unmodified laws, e.g. normalization,
+    # so LawModifiedDate of previous run is not trusted
+    VERSION = 1
+
+    def __init__(
+            self,
+            filepath: str,
+            delta_filepath: str):
+        self.filepath = filepath
+        self.delta_filepath = delta_filepath
+        self.previous = {}
+        self.trust_modified_date = False
+        if os.path.exists(filepath):
+            with open(filepath, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            self.previous = manifest['laws']
+            self.trust_modified_date = manifest.get('version') == self.VERSION
+        self.laws = {}
+        self.delta = JsonLinesWriter(delta_filepath)
+        self.added = 0
+        self.changed = 0
+        self.removed = 0
+
+    # compare articles of a law with previous run, and write delta
+    def update(
+            self,
+            law_url: str,
+            modified_date: str,
+            articles: list[dict]):
+        previous = self.previous.get(law_url)
+
+        # skip hashing if law is not modified since previous run
+        if previous and self.trust_modified_date and modified_date \
+                and previous['modified_date'] == modified_date:
+            self.laws[law_url] = previous
+            return
+
+        previous_hashes = previous['articles'] if previous else {}
+        # category of previous run, unknown for manifest written before it was recorded
+        previous_category = previous.get('category') if previous else None
+        category = articles[0]['LawCategory'] if articles else previous_category
+        hashes = {}
+        for article in articles:
+            id = article_id(article['LawURL'], article['LawArticleNo'])
+            hashes[id] = hashlib.sha1(json.dumps(
+                article, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+            if id not in previous_hashes:
+                self.added += 1
+            elif previous_hashes[id] != hashes[id]:
+                self.changed += 1
+            else:
+                continue
+            row = {'op': 'upsert', 'id': id, 'article': article}
+            if previous_category and previous_category != category:
+                row['previous_category'] = previous_category
+            self.delta.write(row)
+        self._remove(previous_hashes.keys() - hashes.keys())
+
+        self.laws[law_url] = {
+            'modified_date': modified_date,
+            'category': category,
+            'articles': hashes,
+        }
+
+    def _remove(self, ids: Iterable[str]):
+        for id in ids:
+            self.removed += 1
+            self.delta.write({'op': 'delete', 'id': id})
+
+    # write delta of removed laws and save manifest for next run
+    def close(self):
+        # laws not seen in this run are removed, abandoned or not allowed anymore
+        for law_url in self.previous.keys() - self.laws.keys():
+            self._remove(self.previous[law_url]['articles'].keys())
+        self.delta.close()
+
+        logger.info(
+            f'Delta of {self.added} added, {self.changed} changed, {self.removed} removed articles')
+        if self.delta.count == 0:
+            os.remove(self.delta_filepath)
+        else:
+            logger.info(f'Delta written to file {self.delta_filepath}')
+
+        # write to a temporary file first, so manifest is never half written
+        with open(f'{self.filepath}.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'version': self.VERSION, 'laws': self.laws},
+                      f, ensure_ascii=False)
+        os.replace(f'{self.filepath}.tmp', self.filepath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # keep previous manifest if transform failed
+        if exc_type is not None:
+            self.delta.close()
+            os.remove(self.delta_filepath)
+            return
+        self.close()
@@ -0,0 +1,136 @@
+# Benchmark sustained embedding throughput against a local stub endpoint,
+# compare the process pool used before with the asyncio embedding engine
+#
+# Usage: PYTHONPATH=app python -m benchmark.embedding_throughput [--chunks 2000] [--latency 0.3]
+
+import os
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+import threading
+from array import array
+from multiprocessing import Pool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Import proprietory module
+import config.env
+
+
+# A stub of OpenAI embeddings endpoint with fixed latency per request
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.3
+    dimensions = 256
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        time.sleep(self.latency)
+
+        data = []
+        for i, _ in enumerate(inputs):
+            vector = array('f', (random.random() for _ in range(self.dimensions)))
+            if body.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(vector.tobytes()).decode('ascii')
+            else:
+                embedding = vector.tolist()
+            data.append({'object': 'embedding', 'index': i, 'embedding': embedding})
+        tokens = sum(len(text) for text in inputs)
+        payload = json.dumps({
+            'object': 'list',
+            'data': data,
+            'model': body.get('model'),
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        }).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def stub_embedder(base_url: str):
+    from langchain_openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(
+        model=os.environ.get('OPENAI_EMBEDDING_MODEL', 'text-embedding-3-large'),
+        openai_api_base=base_url,
+        openai_api_key='stub',
+        check_embedding_ctx_length=False,
+        max_retries=0)
+
+
+# worker function of process pool, one embedder per batch as before
+def _embed_batch(base_url: str, texts: list):
+    return len(stub_embedder(base_url).embed_documents(texts))
+
+
+def run_pool(base_url: str, batches: list) -> float:
+    start = time.perf_counter()
+    with Pool(processes=max(os.cpu_count() - 1, 1)) as pool:
+        results = [pool.apply_async(_embed_batch, (base_url, batch)) for batch in batches]
+        for result in results:
+            result.get()
+    return time.perf_counter() - start
+
+
+def run_engine(base_url: str, batches: list, concurrency: int) -> float:
+    from index.engine import EmbeddingEngine, EmbeddingTask
+
+    embedding = stub_embedder(base_url)
+
+    async def handler(texts: list):
+        await embedding.aembed_documents(texts)
+
+    start = time.perf_counter()
+    asyncio.run(EmbeddingEngine(max_concurrency=concurrency).run(
+        (EmbeddingTask(batch, tokens=0) for batch in batches),
+        handler,
+        total=len(batches)))
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    from util.openai import count_tokens
+    from util.tqdm import iter_batches
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=2000, help='number of chunks')
+    parser.add_argument('--chunk-length', type=int, default=400, help='characters per chunk')
+    parser.add_argument('--latency', type=float, default=0.3, help='stub latency per request in seconds')
+    parser.add_argument('--concurrency', type=int, default=32, help='max in-flight requests of engine')
+    parser.add_argument('--max-inputs', type=int, default=16, help='max inputs per request')
+    args = parser.parse_args()
+
+    StubHandler.latency = args.latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+    random.seed(0)
+    texts = [
+        ''.join(chr(random.randint(0x4e00, 0x9fa5)) for _ in range(args.chunk_length))
+        for _ in range(args.chunks)]
+    token_counts = count_tokens(texts)
+    tokens = sum(token_counts)
+    # batches planned the same way for both, so only concurrency differs
+    batches = [
+        batch for batch, _ in iter_batches(
+            zip(texts, token_counts), max_inputs=args.max_inputs)]
+    print(f'{len(texts)} chunks, {tokens} tokens, {len(batches)} batches, '
+          f'stub latency {args.latency}s')
+
+    print(f'{"method":<10}{"wall (s)":>10}{"tokens/s":>12}')
+    for name, run in [
+            ('pool', lambda: run_pool(base_url, batches)),
+            ('engine', lambda: run_engine(base_url, batches, args.concurrency))]:
+        elapsed = run()
+        print(f'{name:<10}{elapsed:>10.2f}{tokens / elapsed:>12.0f}')
+
+    server.shutdown()
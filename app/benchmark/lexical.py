@@ -0,0 +1,64 @@
+# Benchmark build time, size and query latency of the lexical index of a
+# collection, built from its chunk stores. Queries are substrings sampled
+# from chunks, e.g. a statute name or an article, and a query is found if
+# its chunk is ranked in top k by BM25
+#
+# Usage: PYTHONPATH=app python -m benchmark.lexical [--vectorstore assets/chorma/law] [--collection taiwan_law]
+
+import os
+import time
+import random
+import argparse
+import tempfile
+
+# Import proprietory module
+import config.env
+
+
+if __name__ == '__main__':
+    from index.chunk_store import chunk_stores
+    from index.lexical import LexicalIndex, build_lexical_index
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectorstore',
+                        type=str,
+                        default=os.environ.get('EMBEDDINGS_TAIWAN_LAW_FILEPATH'),
+                        help='path of vectorstore')
+    parser.add_argument('--collection',
+                        type=str,
+                        default=os.environ.get('EMBEDDINGS_TAIWAN_LAW_COLLECTION_NAME'),
+                        help='collection name')
+    parser.add_argument('--queries', type=int, default=200, help='substrings sampled as queries')
+    parser.add_argument('--length', type=int, default=8, help='characters of each query')
+    parser.add_argument('--k', type=int, default=10, help='top k to be found')
+    args = parser.parse_args()
+
+    stores = chunk_stores(args.vectorstore, args.collection)
+    if not stores:
+        raise SystemExit(f'No chunk stores of {args.collection} in {args.vectorstore}')
+    chunks = [chunk for store in stores for chunk in store]
+
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, 'lexical.sqlite3')
+        start = time.perf_counter()
+        count = build_lexical_index(chunks, filepath)
+        build_seconds = time.perf_counter() - start
+        index = LexicalIndex(filepath)
+        print(f'Collection {args.collection}, {count} chunks, built in {build_seconds:.1f}s, '
+              f'{os.path.getsize(filepath) / 1024 / 1024:.1f} MB')
+
+        rng = random.Random(0)
+        found = 0
+        latencies = []
+        for chunk in rng.sample(chunks, min(args.queries, len(chunks))):
+            offset = rng.randrange(max(len(chunk['text']) - args.length, 1))
+            query = chunk['text'][offset:offset + args.length]
+            start = time.perf_counter()
+            ids, _ = index.search(query, args.k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found += chunk['id'] in ids
+        index.close()
+
+    latencies.sort()
+    print(f'{len(latencies)} queries of {args.length} characters, found@{args.k} {found / len(latencies):.3f}, '
+          f'p50 {latencies[len(latencies) // 2]:.3f} ms, p95 {latencies[len(latencies) * 95 // 100]:.3f} ms')
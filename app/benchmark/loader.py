@@ -0,0 +1,64 @@
+# Benchmark peak memory and wall time of loading open data in JSON format,
+# compare loading the whole document by `loader` with streaming by `iter_loader`
+#
+# Usage: PYTHONPATH=app python -m benchmark.loader [--filepath assets/law.json/ChLaw.json]
+
+import os
+import time
+import resource
+import argparse
+import multiprocessing
+
+# Import proprietory module
+import config.env
+
+
+# peak resident set size of current process in MB
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    if os.uname().sysname == 'Darwin':
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+# load and walk through every record in a child process
+def measure(method: str, filepath: str, results):
+    from assets.transform import loader, iter_loader
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if method == 'loader':
+        records = loader(filepath)
+    else:
+        records = iter_loader(filepath)
+    laws, articles = 0, 0
+    for record in records:
+        laws += 1
+        articles += len(record.get('LawArticles', []))
+    elapsed = time.perf_counter() - start
+    results.put((method, laws, articles, elapsed, peak_rss_mb() - baseline))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filepath',
+                        type=str,
+                        default=os.environ.get('LAW_FILEPATH'),
+                        help='open data file in JSON format')
+    args = parser.parse_args()
+
+    size_mb = os.path.getsize(args.filepath) / 1024 / 1024
+    print(f'File {args.filepath}, {size_mb:.1f} MB')
+    print(f'{"method":<12}{"laws":>8}{"articles":>10}{"wall (s)":>10}{"peak RSS (MB)":>15}')
+
+    # run each method in a fresh process so peak RSS is not shared
+    results = multiprocessing.Queue()
+    for method in ['loader', 'iter_loader']:
+        process = multiprocessing.Process(
+            target=measure,
+            args=(method, args.filepath, results))
+        process.start()
+        method, laws, articles, elapsed, peak = results.get()
+        process.join()
+        print(f'{method:<12}{laws:>8}{articles:>10}{elapsed:>10.2f}{peak:>15.1f}')
@@ -0,0 +1,71 @@
+# Micro-benchmark text normalization over article text of open data,
+# compare chained str.replace used before with precompiled translation tables,
+# applied once by transform, and with plain str.translate of every character
+#
+# Usage: PYTHONPATH=app python -m benchmark.normalize [--filepath assets/law.json/ChLaw.json]
+
+import os
+import time
+import argparse
+
+# Import proprietory module
+import config.env
+
+
+# transform and indexing passes before a shared normalization stage
+def legacy(text: str) -> str:
+    text = text.replace(' ', '').replace('├', '').replace('─', '').replace(
+        '┼', '').replace('┤', '').replace('│', '')
+    return text.replace('　', ' ').replace('　', ' ')
+
+
+# transform pass with a shared normalization stage, articles are not
+# normalized again at indexing
+def current(text: str) -> str:
+    from util.normalize import normalize
+
+    return normalize(text, remove_space=True)
+
+
+# transform pass translating every character without matching runs first
+def translate(text: str) -> str:
+    from util.normalize import _TABLE_WITHOUT_SPACE
+
+    return text.translate(_TABLE_WITHOUT_SPACE)
+
+
+# best wall time of several runs over all texts
+def measure(func, texts: list[str], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    from assets.transform import iter_loader
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filepath',
+                        type=str,
+                        default=os.environ.get('LAW_FILEPATH'),
+                        help='open data file in JSON format')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs')
+    args = parser.parse_args()
+
+    # collect every text field which is normalized by transform
+    texts = []
+    for law in iter_loader(args.filepath):
+        for article in law['LawArticles']:
+            texts.append(article['ArticleContent'])
+            texts.append(article['ArticleNo'])
+    size_mb = sum(len(text.encode('utf-8')) for text in texts) / 1024 / 1024
+    print(f'File {args.filepath}, {len(texts)} texts, {size_mb:.1f} MB')
+
+    print(f'{"method":<10}{"best (s)":>10}{"MB/s":>10}')
+    for name, func in [('legacy', legacy), ('current', current), ('translate', translate)]:
+        elapsed = measure(func, texts, args.repeat)
+        print(f'{name:<10}{elapsed:>10.3f}{size_mb / elapsed:>10.1f}')
@@ -0,0 +1,123 @@
+# Benchmark recall and latency of reduced dimensions and quantized side index
+# against exact float32 search over full dimensions of a collection. Reduced
+# dimensions are simulated by truncating and renormalizing stored vectors,
+# which is what `dimensions` of text-embedding-3 models returns, and sampled
+# vectors are held out of the collection as queries. Rescoring reads
+# full-precision vectors from memory here, instead of from the collection
+#
+# Usage: PYTHONPATH=app python -m benchmark.quantization [--vectorstore assets/chorma/law] [--collection taiwan_law]
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+# Import proprietory module
+import config.env
+
+
+# ids and vectors of collection
+def load_vectors(vectorstore_filepath: str, collection_name: str, limit: int) -> tuple:
+    import chromadb
+
+    collection = chromadb.PersistentClient(
+        path=vectorstore_filepath).get_collection(collection_name)
+    ids, vectors = [], []
+    for offset in range(0, min(collection.count(), limit), 10000):
+        page = collection.get(
+            include=['embeddings'], limit=min(10000, limit - offset), offset=offset)
+        ids.extend(page['ids'])
+        vectors.extend(page['embeddings'])
+    return ids, np.asarray(vectors, dtype=np.float32)
+
+
+# exact top k of unit queries over unit vectors
+def exact_top_k(vectors: np.ndarray, query: np.ndarray, k: int) -> np.ndarray:
+    scores = vectors @ query
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+# recall against ground truth, and latencies in ms of one setting
+def evaluate(
+        corpus: np.ndarray,
+        queries: np.ndarray,
+        truth: list,
+        dimensions: int,
+        quantization: str,
+        k: int,
+        factor: int) -> tuple:
+    from index.quantized import QuantizedIndex, normalized
+
+    vectors = normalized(corpus[:, :dimensions])
+    queries = normalized(queries[:, :dimensions])
+    index = None
+    if quantization == 'float32':
+        nbytes = vectors.nbytes
+    else:
+        index = QuantizedIndex.from_vectors(np.arange(len(vectors)), vectors, quantization)
+        nbytes = index.nbytes
+
+    first_hits = rescored_hits = 0
+    latencies = []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        if index is None:
+            first = rescored = exact_top_k(vectors, query, k)
+        else:
+            candidates, _ = index.search(query, k * factor)
+            first = candidates[:k]
+            candidates = np.asarray(candidates)
+            rescored = candidates[np.argsort(-(vectors[candidates] @ query))[:k]]
+        latencies.append((time.perf_counter() - start) * 1000)
+        first_hits += len(expected.intersection(first))
+        rescored_hits += len(expected.intersection(rescored))
+
+    latencies.sort()
+    total = k * len(truth)
+    return (nbytes, first_hits / total, rescored_hits / total,
+            latencies[len(latencies) // 2], latencies[len(latencies) * 95 // 100])
+
+
+if __name__ == '__main__':
+    from index.quantized import normalized
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectorstore',
+                        type=str,
+                        default=os.environ.get('EMBEDDINGS_TAIWAN_LAW_FILEPATH'),
+                        help='path of vectorstore')
+    parser.add_argument('--collection',
+                        type=str,
+                        default=os.environ.get('EMBEDDINGS_TAIWAN_LAW_COLLECTION_NAME'),
+                        help='collection name')
+    parser.add_argument('--limit', type=int, default=200000, help='max vectors of collection')
+    parser.add_argument('--queries', type=int, default=200, help='vectors held out as queries')
+    parser.add_argument('--k', type=int, default=10, help='top k to be recalled')
+    parser.add_argument('--factor', type=int, default=4, help='candidates of first pass per top k to be rescored')
+    parser.add_argument('--dimensions', type=int, nargs='*', default=[3072, 1024, 512, 256],
+                        help='dimensions to be compared, up to dimensions of collection')
+    args = parser.parse_args()
+
+    _, vectors = load_vectors(args.vectorstore, args.collection, args.limit)
+    rng = np.random.default_rng(0)
+    held_out = rng.choice(len(vectors), size=min(args.queries, len(vectors) // 10), replace=False)
+    mask = np.ones(len(vectors), dtype=bool)
+    mask[held_out] = False
+    corpus, queries = vectors[mask], vectors[held_out]
+    print(f'Collection {args.collection}, {len(corpus)} vectors of {vectors.shape[1]} dimensions, '
+          f'{len(queries)} queries, recall@{args.k}, {args.factor}x candidates rescored')
+
+    # ground truth by exact search over full dimensions
+    full = normalized(corpus)
+    truth = [set(exact_top_k(full, query, args.k).tolist()) for query in normalized(queries)]
+
+    print(f'{"dimensions":>10}{"dtype":>10}{"index (MB)":>12}{"first pass":>12}'
+          f'{"rescored":>10}{"p50 (ms)":>10}{"p95 (ms)":>10}')
+    for dimensions in sorted({min(d, vectors.shape[1]) for d in args.dimensions}, reverse=True):
+        for quantization in ['float32', 'float16', 'int8']:
+            nbytes, first, rescored, p50, p95 = evaluate(
+                corpus, queries, truth, dimensions, quantization, args.k, args.factor)
+            print(f'{dimensions:>10}{quantization:>10}{nbytes / 1024 / 1024:>12.1f}{first:>12.3f}'
+                  f'{rescored:>10.3f}{p50:>10.2f}{p95:>10.2f}')
@@ -0,0 +1,105 @@
+# Benchmark splitting law articles and investigation reports, compare
+# RecursiveCharacterTextSplitter sized by characters used before with
+# CJKTextSplitter sized by tokens of embedding model
+#
+# Usage: PYTHONPATH=app python -m benchmark.splitter [--law-filepath assets/law.json/ChLaw.json] [--reports-path assets/investigation]
+
+import os
+import time
+import argparse
+import statistics
+
+# Import proprietory module
+import config.env
+
+
+# splitter used before, created on every call as before
+def legacy(texts: list[str], separators: list[str]) -> list[str]:
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    chunks = []
+    for text in texts:
+        chunks.extend(RecursiveCharacterTextSplitter(
+            separators=separators,
+            is_separator_regex=True,
+            chunk_size=800,
+            chunk_overlap=100).split_text(text))
+    return chunks
+
+
+def current(texts: list[str], separators: list[str]) -> list[str]:
+    from util.splitter import CJKTextSplitter
+
+    splitter = CJKTextSplitter(
+        chunk_size=512,
+        chunk_overlap=64,
+        separators=separators)
+    chunks = []
+    for text in texts:
+        chunks.extend(splitter.split_text(text))
+    return chunks
+
+
+def law_texts(filepath: str, limit: int) -> list[str]:
+    from assets.transform import iter_loader
+    from util.normalize import normalize
+
+    texts = []
+    for law in iter_loader(filepath):
+        for article in law['LawArticles']:
+            texts.append(normalize(article['ArticleContent']))
+        if len(texts) >= limit:
+            break
+    return texts[:limit]
+
+
+def report_texts(path: str, limit: int) -> list[str]:
+    from index.word_loader import WordDirectoryLoader
+    from util.normalize import normalize
+
+    texts = []
+    for document in WordDirectoryLoader(path).lazy_load():
+        texts.append(normalize(document.page_content))
+        if len(texts) >= limit:
+            break
+    return texts
+
+
+if __name__ == '__main__':
+    from util.openai import count_tokens
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--law-filepath',
+                        type=str,
+                        default=os.environ.get('LAW_FILEPATH'),
+                        help='open data file of law in JSON format')
+    parser.add_argument('--reports-path',
+                        type=str,
+                        default=os.environ.get('INVESTIGATION_REPORTS_PATH'),
+                        help='directory of investigation reports in doc format')
+    parser.add_argument('--limit', type=int, default=20000, help='max texts of each corpus')
+    args = parser.parse_args()
+
+    corpora = []
+    if args.law_filepath and os.path.exists(args.law_filepath):
+        corpora.append(('law', law_texts(args.law_filepath, args.limit),
+                        ["\n\n", "\r\n", "\n", "。", "？", "："]))
+    if args.reports_path and os.path.isdir(args.reports_path):
+        corpora.append(('reports', report_texts(args.reports_path, args.limit),
+                        ["\n\n", "\n", "。", "："]))
+
+    # load tokenizer and cost patterns of splitter before timing
+    count_tokens(['warm up'])
+    current(['warm up ' * 1024], ["\n"])
+
+    print(f'{"corpus":<10}{"method":<10}{"texts":>8}{"wall (s)":>10}{"chunks":>8}'
+          f'{"mean tok":>10}{"p5 tok":>8}{"p95 tok":>8}{"max tok":>8}')
+    for corpus, texts, separators in corpora:
+        for name, split in [('legacy', legacy), ('current', current)]:
+            start = time.perf_counter()
+            chunks = split(texts, separators)
+            elapsed = time.perf_counter() - start
+            tokens = sorted(count_tokens(chunks)) or [0]
+            print(f'{corpus:<10}{name:<10}{len(texts):>8}{elapsed:>10.2f}{len(chunks):>8}'
+                  f'{statistics.mean(tokens):>10.1f}{tokens[len(tokens) // 20]:>8}'
+                  f'{tokens[len(tokens) * 19 // 20]:>8}{tokens[-1]:>8}')
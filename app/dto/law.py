@@ -21,3 +21,14 @@ class Law(JSONFileWizard):
 @dataclass(frozen=True)
 class LawCollection(JSONListWizard, JSONFileWizard, JSONSerializable):
     data: list[Law]
+
+
+# a stable identity of an article across transform runs
+def article_id(law_url: str, article_no: str) -> str:
+    return f'{law_url}#{article_no}'
+
+
+# shard key of LawCategory, the first two levels, e.g. 行政＞衛生福利部
+# for 行政＞衛生福利部＞食品藥物管理目, which is one shard per ministry
+def category_shard(law_category: str) -> str:
+    return '＞'.join(law_category.split('＞')[:2])
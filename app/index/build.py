@@ -0,0 +1,31 @@
+# A build id of a collection, renewed whenever an embeddings run changes
+# the collection, so caches derived from the collection, e.g. answers of
+# retrieval QA, are invalidated when the collection is rebuilt
+
+import os
+import uuid
+
+
+# filepath of build id next to vectorstore
+def build_id_filepath(vectorstore_filepath: str, collection_name: str) -> str:
+    return os.path.join(vectorstore_filepath, f'{collection_name}.build')
+
+
+# build id of collection, empty if never recorded
+def read_build_id(vectorstore_filepath: str, collection_name: str) -> str:
+    try:
+        with open(build_id_filepath(vectorstore_filepath, collection_name), 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ''
+
+
+# record a new build id, replaced at once so readers never see a partial id
+def renew_build_id(vectorstore_filepath: str, collection_name: str) -> str:
+    build_id = uuid.uuid4().hex
+    filepath = build_id_filepath(vectorstore_filepath, collection_name)
+    os.makedirs(vectorstore_filepath, exist_ok=True)
+    with open(f'{filepath}.tmp', 'w', encoding='utf-8') as f:
+        f.write(build_id)
+    os.replace(f'{filepath}.tmp', filepath)
+    return build_id
@@ -0,0 +1,113 @@
+# A checkpoint of an embedding run, a JSON lines journal of written chunk ids
+# and failed batches, so an interrupted or partially failed run is resumed
+# by skipping written chunks instead of starting over
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+# a batch id derived from its chunk ids
+def batch_id(ids: list[str]) -> str:
+    return hashlib.sha256('\n'.join(ids).encode('utf-8')).hexdigest()[:12]
+
+
+class RunCheckpoint:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        # vectorstore is prepared, e.g. stale chunks are deleted
+        self.initialized = False
+        # chunk ids written to vectorstore
+        self.done = set()
+        # batch id to chunk ids, of failed batches
+        self.failed = {}
+        # sources planned to be embedded, e.g. files of directory sync
+        self.planned = set()
+        self.loaded = False
+        # writer thread and event loop both record into journal
+        self.lock = threading.Lock()
+        self.file = None
+
+    # load journal of previous run, return True if found
+    def load(self) -> bool:
+        if self.loaded:
+            return True
+        if not os.path.exists(self.filepath):
+            return False
+        with open(self.filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may be torn by a crash
+                    continue
+                if entry['op'] == 'init':
+                    self.initialized = True
+                elif entry['op'] == 'done':
+                    self.done.update(entry['ids'])
+                elif entry['op'] == 'failed':
+                    self.failed[entry['batch']] = entry['ids']
+                elif entry['op'] == 'planned':
+                    self.planned.update(entry['sources'])
+        self.loaded = True
+        logger.info(
+            f'Loaded checkpoint {self.filepath}, {len(self.done)} chunks written, '
+            f'{len(self.failed)} batches failed')
+        return True
+
+    # open journal, append to previous one when resuming
+    def open(self, resume: bool = False):
+        os.makedirs(os.path.dirname(self.filepath) or '.', exist_ok=True)
+        self.file = open(self.filepath, 'a' if resume else 'w', encoding='utf-8')
+        # terminate a torn last line, so appended entries stay readable
+        if self.file.tell() > 0:
+            with open(self.filepath, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+
+    def _append(self, entry: dict):
+        with self.lock:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.file.flush()
+
+    def mark_initialized(self):
+        self.initialized = True
+        self._append({'op': 'init'})
+
+    def mark_planned(self, sources: list[str]):
+        self.planned.update(sources)
+        self._append({'op': 'planned', 'sources': sources})
+
+    def mark_done(self, ids: list[str]):
+        self.done.update(ids)
+        self._append({'op': 'done', 'ids': ids})
+
+    def mark_failed(self, ids: list[str], error: Exception):
+        self.failed[batch_id(ids)] = ids
+        self._append({'op': 'failed', 'batch': batch_id(ids), 'ids': ids, 'error': str(error)})
+
+    # chunk ids of failed batches not written afterwards
+    def still_failed(self) -> dict:
+        failed = {}
+        for id, ids in self.failed.items():
+            pending = [chunk for chunk in ids if chunk not in self.done]
+            if pending:
+                failed[id] = pending
+        return failed
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    # remove journal after every chunk is written
+    def remove(self):
+        self.close()
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
@@ -0,0 +1,211 @@
+# A compressed chunk store written at ingestion, keyed by chunk id. Chunks are
+# JSON lines of id, text and metadata, compressed in independent zstd frames,
+# and a sorted offset index of fixed-size records maps chunk id to its frame
+# and line, so a chunk is read by binary search over the memory-mapped index
+# and by decompressing one frame, without Chroma or parsing sources again
+
+import os
+import glob
+import json
+import mmap
+import bisect
+import struct
+import logging
+import functools
+from typing import Callable, Iterable, Iterator
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+# chunk id as 16 bytes, offset and size of frame, and line in frame
+_RECORD = struct.Struct('<16sQII')
+
+
+# filepath of chunk store next to vectorstore, per source since law and
+# order share a collection
+def chunk_store_filepath(
+        vectorstore_filepath: str,
+        collection_name: str,
+        src_filepath: str) -> str:
+    return os.path.join(
+        vectorstore_filepath,
+        f'{collection_name}.{os.path.basename(os.path.normpath(src_filepath))}.chunks.zst')
+
+
+# chunk stores of every source of a collection
+def chunk_stores(vectorstore_filepath: str, collection_name: str) -> list:
+    return [
+        ChunkStore(filepath)
+        for filepath in sorted(glob.glob(os.path.join(
+            glob.escape(vectorstore_filepath), f'{glob.escape(collection_name)}.*.chunks.zst')))]
+
+
+# chunks of ids from any of stores, missing ids are not in result
+def get_chunks(stores: list, ids: Iterable[str]) -> dict:
+    found = {}
+    for store in stores:
+        found.update(store.get_many([id for id in ids if id not in found]))
+    return found
+
+
+class ChunkStoreWriter:
+    def __init__(
+            self,
+            filepath: str,
+            frame_bytes: int = 1 << 15,
+            level: int = 9):
+        import zstandard
+
+        self.filepath = filepath
+        # lines of a frame are compressed together, a larger frame is
+        # compressed better, and a smaller one is read faster by id
+        self.frame_bytes = frame_bytes
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        self.file = open(f'{filepath}.tmp', 'wb')
+        self.lines = []
+        self.size = 0
+        self.records = []
+        self.ids = set()
+        self.raw_bytes = 0
+
+    def add(self, id: str, text: str, metadata: dict):
+        # the same chunk may be produced twice, e.g. repeated paragraphs
+        if id in self.ids:
+            return
+        self.ids.add(id)
+        line = json.dumps(
+            {'id': id, 'text': text, 'metadata': metadata},
+            ensure_ascii=False).encode('utf-8')
+        self.lines.append((id, line))
+        self.size += len(line) + 1
+        if self.size >= self.frame_bytes:
+            self._flush()
+
+    def _flush(self):
+        if not self.lines:
+            return
+        data = b''.join(line + b'\n' for _, line in self.lines)
+        frame = self.compressor.compress(data)
+        offset = self.file.tell()
+        self.file.write(frame)
+        self.records.extend(
+            (bytes.fromhex(id), offset, len(frame), i) for i, (id, _) in enumerate(self.lines))
+        self.raw_bytes += len(data)
+        self.lines = []
+        self.size = 0
+
+    # remove partial store, store of previous run is kept
+    def discard(self):
+        self.file.close()
+        os.remove(f'{self.filepath}.tmp')
+        logger.info(f'Discarded {len(self.ids)} chunks, {self.filepath} of previous run is kept')
+
+    # write index and replace store of previous run, chunks of previous
+    # store are carried over if kept by filter, unless produced by this run
+    def close(self, previous: 'ChunkStore' = None, keep: Callable[[dict], bool] = None):
+        carried = 0
+        if previous is not None and keep is not None:
+            for record in previous:
+                if record['id'] not in self.ids and keep(record):
+                    self.add(record['id'], record['text'], record['metadata'])
+                    carried += 1
+        self._flush()
+        self.file.close()
+        if previous is not None:
+            previous.close()
+
+        self.records.sort()
+        with open(f'{self.filepath}.idx.tmp', 'wb') as f:
+            for record in self.records:
+                f.write(_RECORD.pack(*record))
+        os.replace(f'{self.filepath}.tmp', self.filepath)
+        os.replace(f'{self.filepath}.idx.tmp', f'{self.filepath}.idx')
+        logger.info(
+            f'Saved {len(self.records)} chunks to {self.filepath}, {carried} carried over from previous run, '
+            f'{self.raw_bytes / 1024 / 1024:.1f} MB compressed to {os.path.getsize(self.filepath) / 1024 / 1024:.1f} MB')
+
+
+# chunk ids of memory-mapped index as a sorted sequence for binary search
+class _Ids:
+    def __init__(self, index: mmap.mmap):
+        self.index = index
+
+    def __len__(self) -> int:
+        return len(self.index) // _RECORD.size
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.index[i * _RECORD.size:i * _RECORD.size + 16]
+
+
+class ChunkStore:
+    def __init__(self, filepath: str, frames: int = 16):
+        import zstandard
+
+        self.filepath = filepath
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.data = self._map(filepath)
+        self.index = self._map(f'{filepath}.idx')
+        self.ids = _Ids(self.index)
+        # recently decompressed frames, chunks of a query are often nearby
+        self._frame = functools.lru_cache(maxsize=frames)(self._read_frame)
+
+    # memory-map a file, empty file can not be mapped
+    @staticmethod
+    def _map(filepath: str):
+        with open(filepath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _read_frame(self, offset: int, size: int) -> list:
+        return self.decompressor.decompress(self.data[offset:offset + size]).split(b'\n')
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id: str) -> bool:
+        return self._find(id) is not None
+
+    # frame offset, size and line of chunk id, None if missing
+    def _find(self, id: str) -> tuple:
+        try:
+            key = bytes.fromhex(id)
+        except ValueError:
+            return None
+        i = bisect.bisect_left(self.ids, key)
+        if i == len(self.ids) or self.ids[i] != key:
+            return None
+        return _RECORD.unpack_from(self.index, i * _RECORD.size)[1:]
+
+    # chunk of id as dict of id, text and metadata, None if missing
+    def get(self, id: str) -> dict:
+        found = self._find(id)
+        if found is None:
+            return None
+        offset, size, line = found
+        return json.loads(self._frame(offset, size)[line])
+
+    # chunks of ids, missing ids are not in result
+    def get_many(self, ids: Iterable[str]) -> dict:
+        found = {}
+        for id in ids:
+            chunk = self.get(id)
+            if chunk is not None:
+                found[id] = chunk
+        return found
+
+    # every chunk in order of writing, frame by frame
+    def __iter__(self) -> Iterator[dict]:
+        frames = sorted({
+            _RECORD.unpack_from(self.index, i)[1:3]
+            for i in range(0, len(self.index), _RECORD.size)})
+        for offset, size in frames:
+            for line in self._read_frame(offset, size):
+                if line:
+                    yield json.loads(line)
+
+    def close(self):
+        for mapped in (self.data, self.index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
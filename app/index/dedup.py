@@ -0,0 +1,100 @@
+# Near-duplicate detection of chunks at ingestion. A MinHash signature of
+# character shingles is computed by one permutation hashing, candidates are
+# found by LSH bands of signature, and a chunk is a duplicate if estimated
+# Jaccard similarity to a kept chunk reaches threshold
+
+import os
+import re
+import zlib
+import logging
+from array import array
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+# CJK has no word boundary, whitespace is not part of shingles
+_WHITESPACE = re.compile(r'\s+')
+_EMPTY = (1 << 64) - 1
+
+
+# 64-bit hash of shingle, stable across processes unlike hash() of str
+def _hash(shingle: str) -> int:
+    data = shingle.encode('utf-8')
+    return zlib.crc32(data) << 32 | zlib.crc32(data, 0x9e3779b9)
+
+
+# MinHash signature by one permutation hashing, hash space of overlapping
+# character n-grams is split into bins, and the minimum of each bin is kept
+def signature(text: str, num_perm: int = 64, ngram: int = 3) -> array:
+    text = _WHITESPACE.sub('', text)
+    mins = array('Q', [_EMPTY]) * num_perm
+    for i in range(max(len(text) - ngram + 1, 1)):
+        h = _hash(text[i:i + ngram])
+        b = h % num_perm
+        if h < mins[b]:
+            mins[b] = h
+    return mins
+
+
+# estimated Jaccard similarity of two signatures, empty bins of both are ignored
+def similarity(a: array, b: array) -> float:
+    same = total = 0
+    for x, y in zip(a, b):
+        if x == _EMPTY and y == _EMPTY:
+            continue
+        total += 1
+        same += x == y
+    return same / total if total else 1.0
+
+
+class NearDuplicateFilter:
+    def __init__(
+            self,
+            threshold: float = 0.9,
+            num_perm: int = 64,
+            bands: int = 16):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        # band key to indexes of kept chunks
+        self.buckets = {}
+        self.signatures = []
+        self.ids = []
+
+    # filter configured by environment variable, None if disabled, which
+    # is the default as near-identical chunks may still be distinct
+    @classmethod
+    def from_env(cls) -> 'NearDuplicateFilter':
+        threshold = float(os.environ.get('DEDUP_THRESHOLD', 0))
+        return cls(threshold=threshold) if threshold > 0 else None
+
+    def _band_keys(self, sig: array) -> list:
+        return [
+            (band, hash(tuple(sig[band * self.rows:(band + 1) * self.rows])))
+            for band in range(self.bands)]
+
+    # return id of kept chunk and similarity if text is a near-duplicate,
+    # otherwise keep text and return None
+    def check(self, id: str, text: str) -> tuple:
+        sig = signature(text, self.num_perm)
+        keys = self._band_keys(sig)
+        seen = set()
+        for key in keys:
+            for i in self.buckets.get(key, ()):
+                if i in seen:
+                    continue
+                seen.add(i)
+                score = similarity(sig, self.signatures[i])
+                if score >= self.threshold:
+                    return self.ids[i], score
+
+        index = len(self.signatures)
+        self.signatures.append(sig)
+        self.ids.append(id)
+        for key in keys:
+            bucket = self.buckets.setdefault(key, [])
+            # a few kept chunks per bucket are enough to be compared with
+            if len(bucket) < 8:
+                bucket.append(index)
+        return None
@@ -2,15 +2,33 @@
 
 import os
 import abc
-import time
+import glob
+import json
+import math
+import asyncio
+import itertools
+import collections
 import logging
+import tempfile
 import chromadb
-from langchain_community.vectorstores import Chroma
-from multiprocessing import Pool
-from tqdm import tqdm
-
-from util.openai import embedder, text_splitter, calculate_embedding_cost
-from util.tqdm import chunker
+from typing import Callable, Iterable, Iterator
+
+from dto.law import article_id
+from index.checkpoint import RunCheckpoint
+from index.chunk_store import ChunkStore, ChunkStoreWriter, chunk_store_filepath
+from index.dedup import NearDuplicateFilter
+from index.engine import EmbeddingEngine, EmbeddingTask
+from index.pipeline import Prefetcher, StageCounter, counted
+from index.word_loader import WordDirectoryLoader
+from index.writer import VectorStoreWriter, chunk_id
+from util.normalize import normalize
+from util.openai import (
+    cached_embedder,
+    text_splitter,
+    calculate_embedding_cost,
+    count_tokens
+)
+from util.tqdm import iter_batches
 
 
 # Get logger
@@ -24,8 +42,10 @@ class Embeddings(metaclass=abc.ABCMeta):
             src_filepath: str,
             vectorstore_filepath: str,
             collection_name: str = 'law',
-            chunk_size: int = 800,
-            chunk_overlap: int = 10,):
+            chunk_size: int = 512,
+            chunk_overlap: int = 64,
+            resume: bool = False,
+            max_cost: float = None,):
         self.src_filepath = src_filepath
         self.vectorstore_filepath = vectorstore_filepath
         self.collection_name = collection_name
@@ -37,10 +57,41 @@ class Embeddings(metaclass=abc.ABCMeta):
         # Set to 100% for production.
         self.percentage_of_documents_to_be_processed = int(
             os.environ.get('PERCENTAGE_OF_DOCUMENTS_TO_BE_PROCESSED', 1))
-
-    # Abstract function to load documents from source filepath
+        self.collection = None
+        # links of near-duplicates dropped by this run to kept chunks, saved
+        # next to source once every chunk is written
+        self.duplicates = []
+        self.duplicates_filepath = f'{src_filepath}.duplicates'
+        # source of each kept chunk to be linked by near-duplicates
+        self.kept_sources = {}
+        self.dropped = {'chunks': 0, 'tokens': 0, 'characters': 0}
+        # depth of queue of loaded documents ahead of splitting
+        self.queue_size = int(os.environ.get('EMBEDDING_QUEUE_SIZE', 64))
+        # proceed without confirmation if estimated cost in USD is within max cost
+        self.max_cost = max_cost
+        # skip chunks written by previous run, recorded in checkpoint
+        # next to vectorstore, per source since law and order share a collection
+        self.resume = resume
+        self.checkpoint = RunCheckpoint(os.path.join(
+            vectorstore_filepath,
+            f'{collection_name}.{os.path.basename(os.path.normpath(src_filepath))}.checkpoint'))
+        # chunks of this source by id, next to vectorstore
+        self.chunk_store_filepath = chunk_store_filepath(
+            vectorstore_filepath, collection_name, src_filepath)
+        # documents loaded by this run, keyed by document key
+        self.loaded = set()
+        # chunk ids produced by this run of each document, keyed by stale key
+        self.produced = {}
+        # collection is changed by this run, even if the run fails
+        self.modified = False
+        # run stopped before every chunk is written, e.g. exceeding max cost,
+        # cancelled or failed batches, so scheduled jobs exit with an error
+        self.failed = False
+
+    # Abstract function to load documents from source filepath,
+    # documents may be yielded lazily
     @abc.abstractmethod
-    def _loader(self) -> list:
+    def _loader(self) -> Iterable:
         return NotImplementedError
 
     # Abstract function to split documents into chunked documents
@@ -48,182 +99,644 @@ class Embeddings(metaclass=abc.ABCMeta):
     def _splitter(self, documents: list) -> list:
         return NotImplementedError
 
-    # replace CJK space with normal space
-    def _place_cjk_space(
+    # normalize text, e.g. replace CJK space with normal space
+    def _normalize(
             self,
-            documents: list) -> list:
-        # iterate documents and
-        # replace CJK space with normal space in page_content
+            documents: Iterable) -> Iterator:
+        # iterate documents and normalize page_content lazily
         for doc in documents:
-            doc.page_content = doc.page_content.replace(
-                '　', ' ').replace('\u3000', ' ')
-        return documents
+            doc.page_content = normalize(doc.page_content)
+            yield doc
 
     # initial vectorstore with collection names
     def _init_vectorstore(self):
-        # create vectorstore
-        store = Chroma(
-            collection_name=self.collection_name,
-            persist_directory=self.vectorstore_filepath,
-        )
-        # persist vectorstore
-        store.persist()
-        store = None
-
-    # add documents to vectorstore
-    def _add_documents(
-            self,
-            documents: list) -> bool:
-        return_value = False
+        # open collection once, all writes go through this process
+        if self.collection is None:
+            self.collection = chromadb.PersistentClient(
+                path=self.vectorstore_filepath).get_or_create_collection(self.collection_name)
+
+    # stable id of a chunked document
+    def _chunk_id(self, document) -> str:
+        return chunk_id(document.metadata.get('source', ''), document.page_content)
 
-        # catch exception to prevent from crashing in multiprocessing
+    # embed documents, and hand over records to the single writer
+    async def _aadd_documents(
+            self,
+            documents: list):
+        texts = [doc.page_content for doc in documents]
         try:
-            # create vectorstore
-            store = Chroma(
-                collection_name=self.collection_name,
-                embedding_function=embedder(),
-                persist_directory=self.vectorstore_filepath,
-            )
-            # add documents to vectorstore
-            store.add_documents(
-                documents=documents,
-            )
-            # persist vectorstore
-            store.persist()
-            store = None
-            return_value = True
+            vectors = await self.embedding.aembed_documents(texts)
         except Exception as e:
-            logger.error(
-                f'Add {documents} to {self.collection_name} with error: {e}')
-
-        # debug purpose to list collection names
-        vdb = chromadb.PersistentClient(path=self.vectorstore_filepath)
-        collection_names = vdb.list_collections()
-        logger.debug(f'Collection names: {collection_names}')
-
-        return return_value
-
-    # entry point to run the process
-    def run(self):
-        # load documents
-        logger.info(f'Loading data from {self.src_filepath}')
-        documents = self._loader()
+            # record failed batch, so it is retried by resume
+            self.checkpoint.mark_failed([self._chunk_id(doc) for doc in documents], e)
+            raise
+        records = [
+            (self._chunk_id(doc),
+             vector,
+             doc.metadata,
+             doc.page_content)
+            for doc, vector in zip(documents, vectors)]
+        self.counters['embed'].update(len(records))
+        # block in a thread if writer falls behind, not in event loop
+        await asyncio.to_thread(self.writer.put, records)
+
+    # stream of chunked documents of each loaded document, documents are
+    # loaded lazily and parsed ahead in a thread, bounded by queue size
+    def _iter_split(self, limit: int = None) -> Iterator[list]:
+        documents = counted(self._loader(), self.counters['load'])
+        if limit is not None:
+            documents = itertools.islice(documents, limit)
+        documents = Prefetcher(documents, maxsize=self.queue_size)
+        # decisions only depend on preceding chunks of the stream
+        self.duplicates = []
+        self.kept_sources = {}
+        self.dropped = {'chunks': 0, 'tokens': 0, 'characters': 0}
+        dedup = self._dedup_filter()
+        key = self._document_key()
+        stale_key = self._stale_key()
+        for document in counted(self._normalize(documents), self.counters['normalize']):
+            chunks = self._splitter([document])
+            self.counters['split'].update(len(chunks))
+            if dedup:
+                chunks = self._drop_duplicates(chunks, dedup)
+            # every chunk is saved to chunk store by id, and chunks written
+            # by previous run are skipped
+            ids = [self._chunk_id(chunk) for chunk in chunks]
+            for id, chunk in zip(ids, chunks):
+                self.store.add(id, chunk.page_content, chunk.metadata)
+            if key is not None:
+                self.loaded.add(document.metadata.get(key))
+            # a document without chunks still has its stale chunks deleted
+            if stale_key is not None:
+                self.produced.setdefault(document.metadata.get(stale_key), set()).update(ids)
+            yield [chunk for id, chunk in zip(ids, chunks) if id not in self.written_ids]
+
+    # filter of near-duplicate chunks, None to keep every chunk, e.g. articles
+    # of different statutes are often near-identical
+    def _dedup_filter(self) -> NearDuplicateFilter:
+        return None
+
+    # drop near-duplicates of kept chunks, and link them to kept chunks and
+    # their sources
+    def _drop_duplicates(self, chunks: list, dedup: NearDuplicateFilter) -> list:
+        kept, dropped = [], []
+        for chunk in chunks:
+            id = self._chunk_id(chunk)
+            duplicate = dedup.check(id, chunk.page_content)
+            if duplicate is None:
+                kept.append(chunk)
+                self.kept_sources[id] = chunk.metadata.get('source')
+                continue
+            dropped.append(chunk)
+            self.duplicates.append({
+                'id': id,
+                'source': chunk.metadata.get('source'),
+                'duplicate_of': duplicate[0],
+                'duplicate_of_source': self.kept_sources.get(duplicate[0]),
+                'similarity': round(duplicate[1], 3)})
+        if dropped:
+            self.dropped['chunks'] += len(dropped)
+            self.dropped['tokens'] += sum(count_tokens([chunk.page_content for chunk in dropped]))
+            self.dropped['characters'] += sum(len(chunk.page_content) for chunk in dropped)
+        return kept
+
+    # stream of groups of chunks to be embedded with token count of each,
+    # chunks are tokenized in groups, as tokenizer threads are started per call
+    def _iter_chunks(self, limit: int = None) -> Iterator[list]:
+        chunks = (chunk for chunks in self._iter_split(limit) for chunk in chunks)
+        while group := list(itertools.islice(chunks, 256)):
+            yield list(zip(group, count_tokens([chunk.page_content for chunk in group])))
+
+    # number of documents to be loaded, None if unknown, to cut documents
+    # by percentage
+    def _document_count(self) -> int:
+        return None
+
+    # number of documents cut to {self.percentage_of_documents_to_be_processed}%,
+    # None if every document is processed
+    def _limit(self) -> int:
+        if self.percentage_of_documents_to_be_processed >= 100:
+            return None
+        documents = self._document_count()
+        if documents is None:
+            logger.warning('Number of documents is unknown, every document is processed')
+            return None
         logger.info(
-            f'Loaded {len(documents)} documents from {self.src_filepath}')
-
-        # check length and output the first document for debugging purpose
-        if len(documents) > 0:
-            logger.debug(f'First document: {documents[0]}')
-        else:
-            logger.info('No document loaded, exit')
+            f'Cutting documents to {self.percentage_of_documents_to_be_processed}%')
+        return int(documents * self.percentage_of_documents_to_be_processed / 100)
+
+    # limits of one embedding request to pack batches
+    def _batch_limits(self) -> dict:
+        return {
+            'max_inputs': int(os.environ.get(
+                'EMBEDDING_MAX_INPUTS_PER_REQUEST',
+                getattr(self.embedding.embeddings, 'chunk_size', None) or 2048)),
+            'max_tokens': int(os.environ.get('EMBEDDING_MAX_TOKENS_PER_REQUEST', 300000)),
+        }
+
+    # number of requests to embed a batch, a batch may be sent in several
+    # requests, e.g. Azure embeds one input per request
+    def _requests(self, batch: list) -> int:
+        inputs_per_request = getattr(self.embedding.embeddings, 'chunk_size', None) or 1
+        return math.ceil(len(batch) / inputs_per_request)
+
+    # pack every chunk to be embedded by token count up to provider limits
+    # per request, and spool batches to a file, one batch per line, so cost
+    # is counted over actual chunks before the first request while sources
+    # are read once, return tokens, requests and chunks of planned batches
+    def _plan(self, groups: Iterator[list], spool) -> tuple:
+        tokens = requests = chunks = 0
+        for batch, count in iter_batches(
+                itertools.chain.from_iterable(groups), **self._batch_limits()):
+            spool.write(json.dumps({
+                'tokens': count,
+                'chunks': [
+                    {'text': chunk.page_content, 'metadata': chunk.metadata} for chunk in batch]},
+                ensure_ascii=False) + '\n')
+            tokens += count
+            requests += self._requests(batch)
+            chunks += len(batch)
+        spool.seek(0)
+        return tokens, requests, chunks
+
+    # stream of embedding tasks of planned batches read back from spool
+    def _iter_tasks(self, spool) -> Iterator[EmbeddingTask]:
+        from langchain_core.documents import Document
+
+        for line in spool:
+            planned = json.loads(line)
+            batch = [
+                Document(page_content=chunk['text'], metadata=chunk['metadata'])
+                for chunk in planned['chunks']]
+            yield EmbeddingTask(
+                batch,
+                tokens=planned['tokens'],
+                requests=self._requests(batch))
+
+    # metadata field identifying a loaded document, e.g. article or file,
+    # None if chunk store is rewritten by every run
+    def _document_key(self) -> str:
+        return None
+
+    # metadata field of documents, e.g. article or file, whose chunks of
+    # previous run are deleted unless produced again, once every chunk of
+    # this run is written, None if chunks are only upserted
+    def _stale_key(self) -> str:
+        return None
+
+    # delete chunks of previous run of each loaded document, which are not
+    # produced again, after its replacement is written
+    def _delete_stale_chunks(self):
+        key = self._stale_key()
+        if key is None or not self.produced:
+            return
+        Embeddings._init_vectorstore(self)
+        values = sorted(value for value in self.produced if value is not None)
+        stale = []
+        # look up in batches to keep where clause small
+        for i in range(0, len(values), 500):
+            result = self.collection.get(
+                where={key: {"$in": values[i:i + 500]}},
+                include=['metadatas'])
+            stale.extend(
+                id for id, metadata in zip(result['ids'], result['metadatas'])
+                if id not in self.produced[metadata.get(key)])
+        for i in range(0, len(stale), 500):
+            self.collection.delete(ids=stale[i:i + 500])
+            self.modified = True
+        logger.info(f'Deleted {len(stale)} stale chunks of {len(values)} documents')
+
+    # filter of chunks carried over from chunk store of previous run, None
+    # if chunk store is rewritten by this run, every chunk produced by this
+    # run is saved, including chunks written by resumed run, and chunks of
+    # documents not loaded, e.g. of other categories or cut by percentage,
+    # are kept as they stay in vectorstore
+    def _kept_chunks(self) -> Callable[[dict], bool]:
+        key = self._document_key()
+        if key is None:
+            return None
+        return lambda chunk: chunk['metadata'].get(key) not in self.loaded
+
+    # links of near-duplicates saved by previous run
+    def _previous_duplicates(self) -> list:
+        if not os.path.exists(self.duplicates_filepath):
+            return []
+        with open(self.duplicates_filepath, 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    # filter of links carried over from previous run, None if links are
+    # rewritten by this run
+    def _kept_duplicates(self) -> Callable[[dict], bool]:
+        return None
+
+    # replace links of previous run with links of this run and kept links of
+    # previous run, the file is removed if no chunk is dropped
+    def _save_duplicates(self):
+        keep = self._kept_duplicates()
+        links = []
+        if keep is not None:
+            links = [link for link in self._previous_duplicates() if keep(link)]
+        links.extend(self.duplicates)
+        if not links:
+            if os.path.exists(self.duplicates_filepath):
+                os.remove(self.duplicates_filepath)
             return
+        with open(f'{self.duplicates_filepath}.tmp', 'w', encoding='utf-8') as f:
+            for link in links:
+                f.write(json.dumps(link, ensure_ascii=False) + '\n')
+        os.replace(f'{self.duplicates_filepath}.tmp', self.duplicates_filepath)
+        logger.info(f'Saved {len(links)} near-duplicates to {self.duplicates_filepath}')
+
+    # once every chunk is written, delete stale chunks, replace chunk store and
+    # near-duplicates of previous run with those of this run and kept ones of
+    # previous run, and remove checkpoint
+    def _finalize(self):
+        self._delete_stale_chunks()
+        keep = self._kept_chunks()
+        previous = None
+        if keep is not None and os.path.exists(f'{self.chunk_store_filepath}.idx'):
+            previous = ChunkStore(self.chunk_store_filepath)
+        self.store.close(previous, keep)
+        self._save_duplicates()
+        self.checkpoint.remove()
+
+    # rewrite chunk store without stale chunks of previous run, when chunks
+    # are only deleted from vectorstore
+    def _rewrite_store(self):
+        self.store = ChunkStoreWriter(self.chunk_store_filepath)
+        self._finalize()
+
+    # embed streamed tasks with bounded in-flight requests and rate budgets,
+    # return number of succeeded and failed batches
+    async def _embed(self, spool, total: int) -> tuple:
+        engine = EmbeddingEngine.from_env()
+        # read next batches while in-flight batches are embedded
+        tasks = Prefetcher(
+            self._iter_tasks(spool),
+            maxsize=engine.max_concurrency)
+        return await engine.run(
+            tasks,
+            self._aadd_documents,
+            total=total,
+            postfix=lambda: {
+                counter.name: f'{counter.rate():.1f}/s' for counter in self.counters.values()})
+
+    # record chunks written by writer
+    def _on_written(self, ids: list[str]):
+        self.modified = True
+        self.counters['write'].update(len(ids))
+        self.checkpoint.mark_done(ids)
+
+    # entry point to run the process, return True if every chunk is written,
+    # chunks are saved to a new chunk store, which replaces the one of
+    # previous run only if every chunk is written, so chunk store never
+    # holds chunks missing in vectorstore
+    def run(self) -> bool:
+        logger.info(f'Saving chunks to {self.chunk_store_filepath}')
+        self.store = ChunkStoreWriter(self.chunk_store_filepath)
+        completed = False
+        try:
+            completed = self._ingest()
+        finally:
+            if completed:
+                self._finalize()
+            else:
+                self.store.discard()
+        return completed
+
+    # documents stream through load, normalize and split stages with bounded
+    # queues into planned batches spooled to a file, and planned batches
+    # stream through embed and write stages, so memory is bounded by queue
+    # depth instead of corpus size, and cost is counted before embedding
+    def _ingest(self) -> bool:
+        # planned batches are spooled next to vectorstore
+        os.makedirs(self.vectorstore_filepath, exist_ok=True)
+        with tempfile.TemporaryFile(
+                'w+', encoding='utf-8', dir=self.vectorstore_filepath) as spool:
+            return self._ingest_spooled(spool)
+
+    # plan batches into spool, ask for confirmation or check max cost, and
+    # embed planned batches
+    def _ingest_spooled(self, spool) -> bool:
+        # skip chunks written by previous run
+        self.written_ids = frozenset()
+        if self.resume and self.checkpoint.load():
+            self.written_ids = frozenset(self.checkpoint.done)
+
+        # embeddings of unchanged chunks are taken from cache instead of calling the API
+        self.embedding = cached_embedder()
 
-        # cut documents to {self.percentage_of_documents_to_be_processed}%
-        if self.percentage_of_documents_to_be_processed < 100:
+        logger.info(f'Loading data from {self.src_filepath}')
+        self.counters = {
+            name: StageCounter(name) for name in ['load', 'normalize', 'split', 'embed', 'write']}
+        stream = self._iter_chunks(self._limit())
+        try:
+            tokens, total, chunks = self._plan(stream, spool)
+        finally:
+            # stop loading documents if planning fails
+            stream.close()
+        if not self.counters['normalize'].count:
+            logger.info('No document loaded, exit')
+            return False
+        if chunks:
+            # token and cost of chunks to be embedded
+            total_tokens, total_cost = calculate_embedding_cost([tokens])
+            limits = self._batch_limits()
             logger.info(
-                f'Cutting documents to {self.percentage_of_documents_to_be_processed}%')
-            documents = documents[:int(
-                len(documents)*self.percentage_of_documents_to_be_processed/100)]
-
-        # replace CJK space with normal space
-        logger.info('Replacing CJK space with normal space')
-        documents = self._place_cjk_space(documents)
-
-        logger.info(f'Ready to process {len(documents)} documents')
+                f'Ready to process {chunks} chunks with chunk size {self.chunk_size} and overlap {self.chunk_overlap}, '
+                f'tokens: {total_tokens}, cost: USD${total_cost:.5f}, {total} requests, '
+                f'up to {limits["max_inputs"]} inputs and {limits["max_tokens"]} tokens per request')
+
+            # proceed within cost budget if given, e.g. scheduled jobs,
+            # otherwise ask for confirmation to proceed or not
+            if self.max_cost is not None:
+                if total_cost > self.max_cost:
+                    logger.info(
+                        f'Total cost USD${total_cost:.5f} exceeds max cost USD${self.max_cost:.5f}, exit')
+                    self.failed = True
+                    return False
+                logger.info(f'Total cost is within max cost USD${self.max_cost:.5f}, proceed')
+            else:
+                proceed = input('Do you want to proceed? (yes/no)')
+                if proceed.lower() in ["yes", "y"]:
+                    logger.info('User confirmed to proceed')
+                else:
+                    logger.info('User cancelled the process')
+                    self.failed = True
+                    return False
+        else:
+            logger.info('All chunks are written, exit')
+            self._report_duplicates()
+            return True
 
-        # split documents into chunked documents
-        logger.info(
-            f'Splitting documents into chunked documents with chunk size {self.chunk_size} and overlap {self.chunk_overlap}')
-        chunked_documents = self._splitter(documents)
-        # output the first chunked document for debugging purpose
-        logger.debug(f'First chunked document: {chunked_documents[0]}')
+        # precreate vectorstore with collection names
+        self.checkpoint.open(resume=self.resume)
+        self._init_vectorstore()
+        self.checkpoint.mark_initialized()
+
+        # embed planned batches concurrently, the workload is network bound,
+        # and one writer upserts embedded records in large batches
+        self.writer = VectorStoreWriter(
+            self.collection,
+            on_written=self._on_written,
+            on_failed=self.checkpoint.mark_failed).start()
+        try:
+            succeeded, failed = asyncio.run(self._embed(spool, total))
+        finally:
+            # written chunks are in checkpoint even if interrupted
+            self.writer.close()
+            self.checkpoint.close()
 
-        # save chunked documents to file
-        logger.info(
-            f'Saving chunked documents to file {self.src_filepath}.documents')
-        with open(f'{self.src_filepath}.documents', 'w', encoding='utf-8') as f:
-            for document in chunked_documents:
-                f.write(f'{document}\n')
+        logger.info(f'Batch {succeeded} processed, {failed} failed')
+        logger.info(f'Stages: {", ".join(str(counter) for counter in self.counters.values())}')
+        self._report_duplicates()
 
-        # estimate token and cost
-        total_tokens, total_cost = calculate_embedding_cost(documents)
-        logger.info(
-            f'Total tokens: {total_tokens}, total cost: USD${total_cost:.5f}')
+        return self._summarize()
 
-        # ask for confirmation to proceed or not
-        proceed = input('Do you want to proceed? (yes/no)')
-        if proceed.lower() in ["yes", "y"]:
-            logger.info('User confirmed to proceed')
-        else:
-            logger.info('User cancelled the process')
+    # report embedding cost and index size saved by dropping near-duplicates
+    def _report_duplicates(self):
+        if not self.dropped['chunks']:
             return
-
-        # calculate batch size based on total documents
-        # batch size is the number of documents to be processed in one batch
-        batches, batch_size = chunker(chunked_documents)
+        _, saved_cost = calculate_embedding_cost([self.dropped['tokens']])
         logger.info(
-            f'Batch size is {batch_size}, total batches is {len(batches)}')
-
-        # determine number of worker by CPU count, and reserve one for main process
-        worker_count = os.cpu_count() - 1
-        logger.info(f'Worker count is {worker_count}')
-
-        # create progress bar and prepare to enqueue tasks
-        logger.info('Enqueue tasks...(this may take a while)')
-        pbar = tqdm(total=len(batches))
+            f'Dropped {self.dropped["chunks"]} near-duplicate chunks of {self.dropped["tokens"]} tokens, '
+            f'saved USD${saved_cost:.5f} of embedding, and {self.dropped["chunks"]} vectors and '
+            f'{self.dropped["characters"]} characters of index, see {self.duplicates_filepath}')
+
+    # summarize chunks still failed, return True if every chunk is written
+    def _summarize(self) -> bool:
+        still_failed = self.checkpoint.still_failed()
+        if not still_failed:
+            return True
+        for id, ids in still_failed.items():
+            logger.error(f'Batch {id} failed with {len(ids)} chunks not written')
+        logger.error(
+            f'{sum(len(ids) for ids in still_failed.values())} chunks in {len(still_failed)} batches failed, '
+            f'rerun with --resume to retry them, checkpoint {self.checkpoint.filepath}')
+        self.failed = True
+        return False
+
+    # rebuild quantized side index of collection for first-pass search,
+    # if configured by VECTOR_QUANTIZATION
+    def build_side_index(self):
+        from index.quantized import build_side_index, side_index_quantization
+
+        quantization = side_index_quantization()
+        if quantization is None:
+            return
+        Embeddings._init_vectorstore(self)
+        build_side_index(
+            self.collection,
+            self.vectorstore_filepath,
+            self.collection_name,
+            quantization)
+
+    # rebuild lexical index of collection from chunk stores for hybrid
+    # search, unless disabled by LEXICAL_INDEX
+    def build_lexical_index(self):
+        from index.lexical import build_collection_lexical_index, lexical_index_enabled
+
+        if not lexical_index_enabled():
+            return
+        build_collection_lexical_index(self.vectorstore_filepath, self.collection_name)
 
-        # precreate vectorstore with collection names
-        self._init_vectorstore()
+    # renew build id of collection, caches derived from the collection are
+    # invalidated by a new build id
+    def renew_build_id(self):
+        from index.build import renew_build_id
 
-        def update_progress(result):
-            pbar.update(1)
-            # pause 10 mini seconds to avoid too many requests
-            time.sleep(0.01)
+        build_id = renew_build_id(self.vectorstore_filepath, self.collection_name)
+        logger.info(f'Renewed build id of collection {self.collection_name}: {build_id}')
 
-        def update_error(error):
-            logger.error(f'Error: {error}')
 
-        with Pool(processes=worker_count) as pool:
-            # enqueue tasks
-            for batch in batches:
-                pool.apply_async(self._add_documents,
-                                 (batch, ),
-                                 callback=update_progress,
-                                 error_callback=update_error,)
-            # close the process pool
-            pool.close()
-            # wait for all tasks to finish
-            pool.join()
+# A class to create embeddings for law in JSON format
+class LawEmbeddings(Embeddings):
+    def __init__(
+            self,
+            *args,
+            delta: bool = False,
+            categories: list[str] = [],
+            **kwargs):
+        super().__init__(*args, **kwargs)
+        # apply pending delta files of incremental transform instead of
+        # loading all transformed articles
+        self.delta = delta
+        # law categories to be embedded, all categories if empty
+        self.categories = categories
+        self.delta_filepaths = []
+        self.upserts = {}
+        self.deletes = set()
+        # selected shard files, read from category index once
+        self.shards = None
+
+    # fold pending delta files in order, the last operation of an article wins
+    def _load_delta(self):
+        self.delta_filepaths = sorted(
+            glob.glob(os.path.join(self.src_filepath, '*.delta')))
+        self.upserts = {}
+        self.deletes = set()
+        for delta_filepath in self.delta_filepaths:
+            with open(delta_filepath, 'r', encoding='utf-8') as f:
+                for line in f:
+                    row = json.loads(line)
+                    if row['op'] == 'upsert':
+                        if self._is_selected(row['article']['LawCategory']):
+                            self.upserts[row['id']] = row['article']
+                            self.deletes.discard(row['id'])
+                            continue
+                        # articles of other categories are left alone, unless
+                        # moved out of selected categories
+                        previous_category = row.get('previous_category')
+                        if not previous_category or not self._is_selected(previous_category):
+                            continue
+                    # articles removed from open data are deleted whatever
+                    # their category, deleting an article not in collection
+                    # is a no-op
+                    self.upserts.pop(row['id'], None)
+                    self.deletes.add(row['id'])
+        logger.info(
+            f'Loaded {len(self.delta_filepaths)} delta files with {len(self.upserts)} upserts and {len(self.deletes)} deletes')
 
-            # pause 100 mini seconds to update progress bar
-            time.sleep(0.1)
+    # articles are normalized once by transform, so they pass through
+    def _normalize(
+            self,
+            documents: Iterable) -> Iterator:
+        return iter(documents)
+
+    # check if law category is any of selected categories
+    def _is_selected(self, law_category: str) -> bool:
+        if not self.categories:
+            return True
+        for category in self.categories:
+            if category in law_category:
+                return True
+        return False
+
+    # select shard files holding any of selected categories by category
+    # index, return number of selected articles of each shard file
+    def _select_shards(self) -> dict:
+        if self.shards is not None:
+            return self.shards
+        self.shards = {}
+        for index_filepath in sorted(glob.glob(os.path.join(self.src_filepath, '*.categories'))):
+            with open(index_filepath, 'r', encoding='utf-8') as f:
+                shards = json.load(f)['shards']
+            for key, shard in shards.items():
+                articles = sum(
+                    count for category, count in shard['categories'].items()
+                    if self._is_selected(category))
+                if articles:
+                    logger.info(f'Selected shard {key} with {articles} articles')
+                    self.shards[os.path.join(self.src_filepath, shard['file'])] = articles
+        if not self.shards:
+            logger.warning(
+                f'No shard of categories {self.categories} in category index of {self.src_filepath}')
+        return self.shards
+
+    # number of upserted articles, or selected articles by category index
+    def _document_count(self) -> int:
+        if self.delta:
+            return len(self.upserts)
+        return sum(self._select_shards().values())
+
+    # delete chunks of removed articles from vectorstore
+    def _delete_articles(self, ids: list[str]):
+        # delete in batches to keep where clause small
+        for i in range(0, len(ids), 500):
+            self.collection.delete(where={"article_id": {"$in": ids[i:i + 500]}})
+            self.modified = True
+        logger.info(f'Deleted chunks of {len(ids)} articles')
+
+    # delete chunks of removed articles when applying delta, along with stale
+    # chunks of upserted articles, once every replacement is written, so
+    # chunk store never holds deleted chunks
+    def _finalize(self):
+        if self.delta:
+            Embeddings._init_vectorstore(self)
+            self._delete_articles(sorted(self.deletes))
+        super()._finalize()
+
+    # chunks are kept per article
+    def _document_key(self) -> str:
+        return 'article_id'
+
+    # chunks of an upserted article are replaced when applying delta
+    def _stale_key(self) -> str:
+        return 'article_id' if self.delta else None
+
+    # every upserted article is embedded when applying delta, which is
+    # marked as applied afterwards
+    def _limit(self) -> int:
+        if self.delta:
+            return None
+        return super()._limit()
+
+    # chunks of deleted articles are stale when applying delta
+    def _kept_chunks(self) -> Callable[[dict], bool]:
+        keep = super()._kept_chunks()
+        if not self.delta:
+            return keep
+        return lambda chunk: keep(chunk) and chunk['metadata'].get('article_id') not in self.deletes
+
+    # links of previous run are kept when applying delta, as articles are
+    # never dropped as near-duplicates
+    def _kept_duplicates(self) -> Callable[[dict], bool]:
+        if not self.delta:
+            return super()._kept_duplicates()
+        return lambda link: True
 
-        pbar.close()
+    # entry point to run the process
+    def run(self) -> bool:
+        if not self.delta:
+            return super().run()
 
-        logger.info(f'Batch {len(batches)} processed')
+        self._load_delta()
+        if not self.delta_filepaths:
+            logger.info('No delta to apply, exit')
+            return False
 
+        if self.upserts:
+            processed = super().run()
+        else:
+            # nothing to embed, only delete removed articles
+            self._init_vectorstore()
+            self._rewrite_store()
+            processed = True
+
+        # mark delta files as applied once every upserted article is written,
+        # so they are not applied again
+        if processed:
+            for delta_filepath in self.delta_filepaths:
+                os.replace(delta_filepath, f'{delta_filepath}.applied')
+        return processed
 
-# A class to create embeddings for law in JSON format
-class LawEmbeddings(Embeddings):
     # custom function to load documents from source filepath
-    def _loader(self) -> list:
-        from langchain_community.document_loaders import (
-            DirectoryLoader,
-            JSONLoader
-        )
-
-        # enumerate the source filepath, and
-        # only load .json file into a list of Document objects
-        loader = DirectoryLoader(
-            self.src_filepath,
-            glob="*.json",
-            loader_cls=JSONLoader,
-            loader_kwargs={
-                "jq_schema": '.data[]',
-                "content_key": 'LawArticleContent',
-                "metadata_func": self._metadata_func},
-            show_progress=True,)
-        return loader.load()
+    def _loader(self) -> Iterable:
+        from langchain_community.document_loaders import JSONLoader
+        from langchain_core.documents import Document
+
+        # only upserted articles from delta files
+        if self.delta:
+            return [
+                Document(
+                    page_content=article['LawArticleContent'],
+                    metadata=self._metadata_func(
+                        article,
+                        {"source": self.src_filepath, "seq_num": i + 1}))
+                for i, article in enumerate(self.upserts.values())]
+
+        # load selected shards lazily, each holds one article per line,
+        # and filter categories more specific than shard
+        return (
+            doc
+            for filepath in self._select_shards()
+            for doc in JSONLoader(
+                filepath,
+                jq_schema='.',
+                content_key='LawArticleContent',
+                json_lines=True,
+                metadata_func=self._metadata_func).lazy_load()
+            if self._is_selected(doc.metadata["law_category"]))
 
     # custom function to split documents into chunked documents
     def _splitter(self, documents: list) -> list:
@@ -255,6 +768,9 @@ class LawEmbeddings(Embeddings):
         metadata["law_category"] = record.get("LawCategory")
         metadata["law_article_chapter"] = record.get("LawArticleChapter")
         metadata["law_article_no"] = record.get("LawArticleNo")
+        # stable identity to delete chunks of article when applying delta
+        metadata["article_id"] = article_id(
+            record.get("LawURL"), record.get("LawArticleNo"))
 
         # replace source with law url
         if record.get("LawURL"):
@@ -263,24 +779,222 @@ class LawEmbeddings(Embeddings):
         return metadata
 
 
-# A class to create embeddings for investigation reports in doc format
-class InvestigationReportEmbeddings(Embeddings):
+# A base class to create embeddings for Word documents in a directory
+class DirectoryEmbeddings(Embeddings):
+    def __init__(
+            self,
+            *args,
+            sync: bool = False,
+            **kwargs):
+        super().__init__(*args, **kwargs)
+        # embed only new and changed files, and delete chunks of removed
+        # files, by diffing directory with indexed sources
+        self.sync = sync
+        # files to be embedded, all files if None
+        self.filepaths = None
+        # source to content hash of changed files, and removed sources
+        self.changed = {}
+        self.removed = []
+        # content hash of each file in directory
+        self.file_hashes = {}
+        # content hash of files without chunks, e.g. empty files, next to
+        # vectorstore, so they are not planned again by next sync
+        self.empty_filepath = os.path.join(
+            self.vectorstore_filepath,
+            f'{self.collection_name}.{os.path.basename(os.path.normpath(self.src_filepath))}.empty')
+
     # custom function to load documents from source filepath
-    def _loader(self) -> list:
-        from langchain_community.document_loaders import (
-            DirectoryLoader,
-            UnstructuredWordDocumentLoader
-        )
-
-        # enumerate the source filepath, and
-        # only load .doc file into a list of Document objects
-        loader = DirectoryLoader(
+    def _loader(self) -> Iterable:
+        # enumerate the source filepath, and only load .doc file lazily,
+        # files are parsed in a process pool unless found in parse cache
+        loader = WordDirectoryLoader(
             self.src_filepath,
-            glob="*.doc*",
-            loader_cls=UnstructuredWordDocumentLoader,
-            show_progress=True,)
-        return loader.load()
+            glob="*.doc*")
+        return loader.lazy_load(self.filepaths)
+
+    # number of files to be loaded
+    def _document_count(self) -> int:
+        if self.filepaths is not None:
+            return len(self.filepaths)
+        return len(WordDirectoryLoader(self.src_filepath, glob="*.doc*")._filepaths())
+
+    # content hashes of each indexed source, paging through metadata
+    def _indexed_sources(self) -> dict:
+        sources = collections.defaultdict(set)
+        offset = 0
+        while True:
+            result = self.collection.get(include=['metadatas'], limit=10000, offset=offset)
+            for metadata in result['metadatas']:
+                sources[metadata.get('source')].add(metadata.get('source_hash'))
+            if len(result['ids']) < 10000:
+                return sources
+            offset += len(result['ids'])
+
+    # content hash of each file without chunks, recorded by previous sync
+    def _empty_sources(self) -> dict:
+        if not os.path.exists(self.empty_filepath):
+            return {}
+        with open(self.empty_filepath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    # diff directory with indexed sources, plan files to be embedded
+    def _diff(self) -> bool:
+        file_hashes = WordDirectoryLoader(self.src_filepath, glob="*.doc*").file_hashes()
+        self.file_hashes = file_hashes
+        indexed = self._indexed_sources()
+        # files without chunks are indexed with their content hash
+        for source, sha256 in self._empty_sources().items():
+            indexed[source].add(sha256)
+        added = [filepath for filepath in file_hashes if filepath not in indexed]
+        self.changed = {
+            filepath: sha256 for filepath, sha256 in file_hashes.items()
+            if filepath in indexed and indexed[filepath] != {sha256}}
+        self.removed = sorted(source for source in indexed if source not in file_hashes)
+        # files planned by interrupted run may be partially written
+        # with current content hash, so they are embedded again
+        planned = [
+            filepath for filepath in self.checkpoint.planned
+            if filepath in file_hashes and filepath not in added and filepath not in self.changed]
+        # files linked to chunks of removed or changed files by near-duplicates
+        relinked = [
+            filepath for filepath in self._relinked_sources(set(self.removed) | self.changed.keys())
+            if filepath in file_hashes and filepath not in added
+            and filepath not in self.changed and filepath not in planned]
+        self.filepaths = sorted(added + list(self.changed) + planned + relinked)
+        logger.info(
+            f'Sync {self.src_filepath} with {len(file_hashes)} files and {len(indexed)} indexed sources: '
+            f'{len(added)} added, {len(self.changed)} changed, {len(self.removed)} removed, '
+            f'{len(planned)} resumed, {len(relinked)} relinked')
+        return bool(self.filepaths or self.removed)
+
+    # delete chunks of removed files
+    def _delete_removed_sources(self):
+        for i in range(0, len(self.removed), 500):
+            self.collection.delete(where={"source": {"$in": self.removed[i:i + 500]}})
+            self.modified = True
+        logger.info(f'Deleted chunks of {len(self.removed)} removed files')
+
+    # files with chunks dropped as near-duplicates of chunks of replaced
+    # files, which are embedded again since kept chunks may be deleted
+    def _relinked_sources(self, replaced: set) -> set:
+        links = self._previous_duplicates()
+        # links saved before source of kept chunk was recorded
+        unknown = sorted({
+            link['duplicate_of'] for link in links if 'duplicate_of_source' not in link})
+        sources = {}
+        for i in range(0, len(unknown), 500):
+            result = self.collection.get(ids=unknown[i:i + 500], include=['metadatas'])
+            sources.update(
+                (id, metadata.get('source')) for id, metadata in zip(result['ids'], result['metadatas']))
+        relinked = set()
+        for link in links:
+            source = link.get('duplicate_of_source', sources.get(link['duplicate_of']))
+            # kept chunk missing in collection is deleted
+            if source is None or source in replaced:
+                relinked.add(link['source'])
+        return relinked
+
+    # near-duplicates are dropped if configured by DEDUP_THRESHOLD, when
+    # syncing kept chunks of files not loaded are seeded from chunk store,
+    # so files are compared with the whole directory as in a full run
+    def _dedup_filter(self) -> NearDuplicateFilter:
+        dedup = NearDuplicateFilter.from_env()
+        if dedup is None or not self.sync or not os.path.exists(f'{self.chunk_store_filepath}.idx'):
+            return dedup
+        loaded = set(self.removed) | set(self.filepaths)
+        store = ChunkStore(self.chunk_store_filepath)
+        try:
+            for chunk in store:
+                source = chunk['metadata'].get('source')
+                if source not in loaded and dedup.check(chunk['id'], chunk['text']) is None:
+                    self.kept_sources[chunk['id']] = source
+        finally:
+            store.close()
+        logger.info(f'Seeded near-duplicate filter with {len(self.kept_sources)} chunks of unchanged files')
+        return dedup
+
+    # chunks are kept per file
+    def _document_key(self) -> str:
+        return 'source'
+
+    # chunks of a loaded file are replaced when syncing, including chunks
+    # indexed before content hash was kept
+    def _stale_key(self) -> str:
+        return 'source' if self.sync else None
+
+    # every planned file is embedded when syncing
+    def _limit(self) -> int:
+        if self.sync:
+            return None
+        return super()._limit()
+
+    # delete chunks of removed files, and record files without chunks, after
+    # every chunk is written, so chunk store never holds deleted chunks
+    def _finalize(self):
+        if self.sync:
+            self._delete_removed_sources()
+        super()._finalize()
+        if not self.sync:
+            return
+        empty = self._empty_sources()
+        for source in self.removed:
+            empty.pop(source, None)
+        for source, ids in self.produced.items():
+            if ids:
+                empty.pop(source, None)
+            else:
+                empty[source] = self.file_hashes.get(source)
+        with open(f'{self.empty_filepath}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(empty, f, ensure_ascii=False, indent=4)
+        os.replace(f'{self.empty_filepath}.tmp', self.empty_filepath)
+
+    # chunks of removed files are stale when syncing, files failed to be
+    # parsed keep their chunks
+    def _kept_chunks(self) -> Callable[[dict], bool]:
+        keep = super()._kept_chunks()
+        if not self.sync:
+            return keep
+        removed = set(self.removed)
+        return lambda chunk: keep(chunk) and chunk['metadata'].get('source') not in removed
+
+    # links of removed files and loaded files are stale when syncing, as
+    # loaded files are linked again by this run
+    def _kept_duplicates(self) -> Callable[[dict], bool]:
+        if not self.sync:
+            return super()._kept_duplicates()
+        stale = set(self.removed) | self.produced.keys()
+        return lambda link: link['source'] not in stale
+
+    # initial vectorstore, and plan files when syncing
+    def _init_vectorstore(self):
+        super()._init_vectorstore()
+        if self.sync:
+            self.checkpoint.mark_planned(self.filepaths)
+
+    # entry point to run the process
+    def run(self) -> bool:
+        if not self.sync:
+            return super().run()
+
+        # planned files of interrupted run
+        if self.resume:
+            self.checkpoint.load()
 
+        # open collection to diff with indexed sources
+        super()._init_vectorstore()
+        if not self._diff():
+            logger.info(f'{self.src_filepath} is in sync, exit')
+            return False
+
+        if self.filepaths:
+            return super().run()
+        # nothing to embed, only delete chunks of removed files
+        self._rewrite_store()
+        return True
+
+
+# A class to create embeddings for investigation reports in doc format
+class InvestigationReportEmbeddings(DirectoryEmbeddings):
     # custom function to split documents into chunked documents
     def _splitter(self, documents: list) -> list:
         return text_splitter(
@@ -291,27 +1005,11 @@ class InvestigationReportEmbeddings(Embeddings):
 
 
 # A class to create embeddings for news in doc format
-class NewsEmbeddings(Embeddings):
-    # custom function to load documents from source filepath
-    def _loader(self) -> list:
-        from langchain_community.document_loaders import (
-            DirectoryLoader,
-            UnstructuredWordDocumentLoader
-        )
-
-        # enumerate the source filepath, and
-        # only load .doc file into a list of Document objects
-        loader = DirectoryLoader(
-            self.src_filepath,
-            glob="*.doc*",
-            loader_cls=UnstructuredWordDocumentLoader,
-            show_progress=True,)
-        return loader.load()
-
+class NewsEmbeddings(DirectoryEmbeddings):
     # custom function to split documents into chunked documents
     def _splitter(self, documents: list) -> list:
         return text_splitter(
             documents,
             self.chunk_size,
             self.chunk_overlap,
-            separators=["\n\n", "\n", "。", "："])
\ No newline at end of file
+            separators=["\n\n", "\n", "。", "："])
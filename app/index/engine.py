@@ -0,0 +1,134 @@
+# An asyncio engine to embed batches of documents, the workload is network
+# bound, so concurrency is bounded by in-flight requests and the provider's
+# tokens-per-minute and requests-per-minute budgets instead of CPU count
+
+import os
+import time
+import asyncio
+import logging
+from typing import AsyncIterable, Awaitable, Callable, Iterable
+from tqdm import tqdm
+
+from util.ratelimit import TokenBucket
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+# A meter of processed tokens, requests and documents
+class ThroughputMeter:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.tokens = 0
+        self.requests = 0
+        self.documents = 0
+
+    def update(self, tokens: int, requests: int, documents: int):
+        self.tokens += tokens
+        self.requests += requests
+        self.documents += documents
+
+    def elapsed(self) -> float:
+        return max(time.monotonic() - self.start, 1e-9)
+
+    def rates(self) -> dict:
+        elapsed = self.elapsed()
+        return {
+            'tokens/s': f'{self.tokens / elapsed:.0f}',
+            'requests/s': f'{self.requests / elapsed:.1f}',
+            'docs/s': f'{self.documents / elapsed:.1f}',
+        }
+
+
+# A batch to be embedded, with its weight against rate budgets
+class EmbeddingTask:
+    def __init__(
+            self,
+            documents: list,
+            tokens: int,
+            requests: int = 1):
+        self.documents = documents
+        self.tokens = tokens
+        self.requests = requests
+
+
+class EmbeddingEngine:
+    def __init__(
+            self,
+            max_concurrency: int = 8,
+            tokens_per_minute: int = None,
+            requests_per_minute: int = None):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+
+    # create engine with budgets configured by environment variables
+    @classmethod
+    def from_env(cls) -> 'EmbeddingEngine':
+        return cls(
+            max_concurrency=int(os.environ.get('EMBEDDING_MAX_CONCURRENCY', 8)),
+            tokens_per_minute=int(os.environ.get('EMBEDDING_TOKENS_PER_MINUTE', 0)),
+            requests_per_minute=int(os.environ.get('EMBEDDING_REQUESTS_PER_MINUTE', 0)))
+
+    # run handler over tasks, return number of succeeded and failed tasks
+    async def run(
+            self,
+            tasks: Iterable[EmbeddingTask] | AsyncIterable[EmbeddingTask],
+            handler: Callable[[list], Awaitable],
+            total: int = None,
+            postfix: Callable[[], dict] = None) -> tuple:
+        logger.info(
+            f'Embedding with max concurrency {self.max_concurrency}, '
+            f'{self.tokens_per_minute or "unlimited"} tokens per minute, '
+            f'{self.requests_per_minute or "unlimited"} requests per minute')
+
+        tokens = TokenBucket(self.tokens_per_minute)
+        requests = TokenBucket(self.requests_per_minute)
+        slots = asyncio.Semaphore(self.max_concurrency)
+        meter = ThroughputMeter()
+        pbar = tqdm(total=total)
+        failed = 0
+
+        async def process(task: EmbeddingTask):
+            nonlocal failed
+            try:
+                await handler(task.documents)
+                meter.update(task.tokens, task.requests, len(task.documents))
+                # rates of engine, and of other stages if given
+                pbar.set_postfix({**meter.rates(), **(postfix() if postfix else {})}, refresh=False)
+            except Exception as e:
+                failed += 1
+                logger.error(f'Error: {e}')
+            finally:
+                slots.release()
+                pbar.update(1)
+
+        # acquire budgets before a task is started, so in-flight tasks
+        # never exceed concurrency and rates stay within budgets
+        running = set()
+
+        async def start(task: EmbeddingTask):
+            await slots.acquire()
+            await requests.acquire(task.requests)
+            await tokens.acquire(task.tokens)
+            future = asyncio.create_task(process(task))
+            running.add(future)
+            future.add_done_callback(running.discard)
+
+        # tasks may be produced by a streaming pipeline
+        if hasattr(tasks, '__aiter__'):
+            async for task in tasks:
+                await start(task)
+        else:
+            for task in tasks:
+                await start(task)
+        if running:
+            await asyncio.wait(running)
+        pbar.close()
+
+        elapsed = meter.elapsed()
+        logger.info(
+            f'Embedded {meter.documents} documents, {meter.tokens} tokens with {meter.requests} requests '
+            f'in {elapsed:.1f}s, {meter.tokens / elapsed:.0f} tokens/s, {failed} failed batches')
+
+        return pbar.n - failed, failed
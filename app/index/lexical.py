@@ -0,0 +1,170 @@
+# A lexical index of chunks of a collection, an inverted index of CJK
+# bigrams and latin words in SQLite scored by BM25, built at ingestion from
+# chunk stores next to the vectorstore. Exact statute names, article numbers
+# and agency names are matched locally without embedding the query
+
+import os
+import re
+import math
+import logging
+import sqlite3
+import threading
+from array import array
+from collections import Counter
+from typing import Iterable, List
+
+import numpy as np
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+# runs of CJK ideographs, and runs of latin letters and digits
+_TERMS = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[0-9a-z]+')
+
+# parameters of BM25
+K1 = 1.2
+B = 0.75
+
+
+# filepath of lexical index next to vectorstore
+def lexical_index_filepath(vectorstore_filepath: str, collection_name: str) -> str:
+    return os.path.join(vectorstore_filepath, f'{collection_name}.bm25.sqlite3')
+
+
+# terms of normalized text, CJK runs are cut into overlapping bigrams, a
+# single ideograph is kept as is, and latin words and numbers are whole terms
+def tokenize(text: str) -> List[str]:
+    terms = []
+    for run in _TERMS.findall(text.lower()):
+        if len(run) > 1 and run[0] >= '\u3400':
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.append(run)
+    return terms
+
+
+# lexical index configured by environment variable, enabled by default
+def lexical_index_enabled() -> bool:
+    return os.environ.get('LEXICAL_INDEX', 'true').lower() not in ('', '0', 'false', 'no')
+
+
+class LexicalIndex:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        # read only, the index is replaced as a whole by next build
+        self.conn = sqlite3.connect(
+            f'file:{filepath}?mode=ro', uri=True, check_same_thread=False)
+        # indexers are shared by sessions of the app
+        self.lock = threading.Lock()
+        # length of each document by row id, row ids start from 1
+        self.lengths = np.zeros(1, dtype=np.float32)
+        rows = self.conn.execute('SELECT length FROM docs ORDER BY id').fetchall()
+        if rows:
+            self.lengths = np.concatenate(
+                [self.lengths, np.asarray([row[0] for row in rows], dtype=np.float32)])
+        self.average_length = float(self.lengths[1:].mean()) if rows else 0.0
+
+    def __len__(self) -> int:
+        return len(self.lengths) - 1
+
+    # chunk ids and BM25 scores of top k documents matching terms of query
+    def search(self, query: str, k: int) -> tuple:
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not len(self):
+            return [], []
+        scores = np.zeros(len(self.lengths), dtype=np.float32)
+        norms = K1 * (1 - B + B * self.lengths / max(self.average_length, 1e-6))
+        with self.lock:
+            for term in terms:
+                row = self.conn.execute(
+                    'SELECT docs, tfs FROM postings WHERE term = ?', (term,)).fetchone()
+                if row is None:
+                    continue
+                docs = np.frombuffer(row[0], dtype=np.uint32)
+                tfs = np.frombuffer(row[1], dtype=np.uint16).astype(np.float32)
+                idf = math.log(1 + (len(self) - len(docs) + 0.5) / (len(docs) + 0.5))
+                scores[docs] += idf * tfs * (K1 + 1) / (tfs + norms[docs])
+            matched = np.flatnonzero(scores)
+            if not len(matched):
+                return [], []
+            top = matched[np.argsort(-scores[matched], kind='stable')[:k]]
+            chunk_ids = dict(self.conn.execute(
+                f'SELECT id, chunk_id FROM docs WHERE id IN ({",".join("?" * len(top))})',
+                [int(doc) for doc in top]).fetchall())
+        return [chunk_ids[int(doc)] for doc in top], [float(scores[doc]) for doc in top]
+
+    def close(self):
+        self.conn.close()
+
+
+# build lexical index of chunks, chunks are dicts of id and text as in
+# chunk stores, postings are collected as flat arrays of term ids, documents
+# and term frequencies, grouped by term with one stable sort, and written
+# as one row per term to a temporary file replaced at once, so a running
+# app keeps reading the previous index
+def build_lexical_index(chunks: Iterable[dict], filepath: str) -> int:
+    term_ids = {}
+    terms_column = array('I')
+    tfs_column = array('I')
+    counts = array('I')
+    docs = []
+    seen = set()
+    for chunk in chunks:
+        # the same chunk may be stored by several sources
+        if chunk['id'] in seen:
+            continue
+        seen.add(chunk['id'])
+        terms = Counter(tokenize(chunk['text']))
+        docs.append((len(docs) + 1, chunk['id'], sum(terms.values())))
+        terms_column.extend([term_ids.setdefault(term, len(term_ids)) for term in terms])
+        tfs_column.extend(terms.values())
+        counts.append(len(terms))
+
+    # documents of each term in ascending order, as stable sort keeps order of documents
+    terms_column = np.frombuffer(terms_column, dtype=np.uint32)
+    order = np.argsort(terms_column, kind='stable')
+    docs_column = np.repeat(
+        np.arange(1, len(docs) + 1, dtype=np.uint32), np.frombuffer(counts, dtype=np.uint32))[order]
+    tfs_column = np.minimum(np.frombuffer(tfs_column, dtype=np.uint32), 0xffff).astype(np.uint16)[order]
+    ends = np.cumsum(np.bincount(terms_column, minlength=len(term_ids)))
+
+    def postings():
+        for term, id in sorted(term_ids.items()):
+            start = ends[id - 1] if id else 0
+            yield term, docs_column[start:ends[id]].tobytes(), tfs_column[start:ends[id]].tobytes()
+
+    if os.path.exists(f'{filepath}.tmp'):
+        os.remove(f'{filepath}.tmp')
+    conn = sqlite3.connect(f'{filepath}.tmp')
+    try:
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute(
+            'CREATE TABLE docs (id INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL, length INTEGER NOT NULL)')
+        conn.execute(
+            'CREATE TABLE postings (term TEXT PRIMARY KEY, docs BLOB NOT NULL, tfs BLOB NOT NULL) WITHOUT ROWID')
+        conn.executemany('INSERT INTO docs (id, chunk_id, length) VALUES (?, ?, ?)', docs)
+        conn.executemany('INSERT INTO postings (term, docs, tfs) VALUES (?, ?, ?)', postings())
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(f'{filepath}.tmp', filepath)
+    return len(docs)
+
+
+# build lexical index of collection from its chunk stores
+def build_collection_lexical_index(vectorstore_filepath: str, collection_name: str) -> int:
+    from index.chunk_store import chunk_stores
+
+    filepath = lexical_index_filepath(vectorstore_filepath, collection_name)
+    stores = chunk_stores(vectorstore_filepath, collection_name)
+    try:
+        count = build_lexical_index(
+            (chunk for store in stores for chunk in store), filepath)
+    finally:
+        for store in stores:
+            store.close()
+    logger.info(
+        f'Built lexical index {filepath} of {count} chunks, '
+        f'{os.path.getsize(filepath) / 1024 / 1024:.1f} MB')
+    return count
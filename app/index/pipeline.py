@@ -0,0 +1,100 @@
+# Building blocks of a streaming ingestion pipeline. Stages are generators
+# chained with bounded queues, so memory is bounded by queue depth instead of
+# corpus size, and every stage reports its throughput
+
+import time
+import queue
+import asyncio
+import threading
+from typing import Iterable, Iterator
+
+
+# A counter of items passed through a stage
+class StageCounter:
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.start = time.monotonic()
+
+    def update(self, count: int = 1):
+        self.count += count
+
+    def rate(self) -> float:
+        return self.count / max(time.monotonic() - self.start, 1e-9)
+
+    def __str__(self) -> str:
+        return f'{self.name} {self.count} ({self.rate():.1f}/s)'
+
+
+# count items of an iterable into counter
+def counted(iterable: Iterable, counter: StageCounter) -> Iterator:
+    for item in iterable:
+        counter.update()
+        yield item
+
+
+# A bounded queue filled by iterating an iterable in a thread, so a stage
+# keeps producing while the next stage consumes, and blocks when it is full
+class Prefetcher:
+    _DONE = object()
+    _EMPTY = object()
+
+    def __init__(self, iterable: Iterable, maxsize: int = 64):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, args=(iterable,), daemon=True)
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        # give up when consumer is stopped, so thread is not blocked forever
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, iterable: Iterable):
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    return
+            self._put(self._DONE)
+        except BaseException as e:
+            # raise error of producer in consumer
+            self._put((self._DONE, e))
+
+    # get next item, never blocked longer than timeout, so an executor
+    # thread waiting for it is released soon when stopped
+    def _get(self, timeout: float = 0.5):
+        try:
+            item = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            if not self.thread.is_alive() and self.queue.empty():
+                return self._DONE
+            return self._EMPTY
+        if isinstance(item, tuple) and len(item) == 2 and item[0] is self._DONE:
+            raise item[1]
+        return item
+
+    def close(self):
+        self.stopped.set()
+
+    def __iter__(self):
+        try:
+            while (item := self._get()) is not self._DONE:
+                if item is not self._EMPTY:
+                    yield item
+        finally:
+            self.close()
+
+    # consume in event loop without blocking it
+    async def __aiter__(self):
+        try:
+            while (item := await asyncio.to_thread(self._get)) is not self._DONE:
+                if item is not self._EMPTY:
+                    yield item
+        finally:
+            self.close()
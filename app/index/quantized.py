@@ -0,0 +1,156 @@
+# A quantized side index of a chroma collection for first-pass search. Vectors
+# are stored as int8 with a scale per vector, or as float16, which is 4 or 2
+# times smaller than float32 of chroma, and only top candidates of first pass
+# are rescored with full-precision vectors from the collection
+
+import os
+import logging
+
+import numpy as np
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+QUANTIZATIONS = ('float16', 'int8')
+
+
+# filepath of side index next to vectorstore
+def side_index_filepath(
+        vectorstore_filepath: str,
+        collection_name: str,
+        quantization: str) -> str:
+    return os.path.join(vectorstore_filepath, f'{collection_name}.{quantization}.npz')
+
+
+# normalize vectors to unit length, so dot product is cosine similarity
+def normalized(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# quantize unit vectors, return codes and scale of each vector
+def quantize(vectors: np.ndarray, quantization: str) -> tuple:
+    if quantization == 'float16':
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+    if quantization == 'int8':
+        # symmetric scale per vector, the largest component maps to 127
+        scales = np.maximum(np.abs(vectors).max(axis=1, initial=0), 1e-12) / 127
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f'Unknown quantization {quantization}, expected one of {QUANTIZATIONS}')
+
+
+class QuantizedIndex:
+    # bytes of codes converted to float32 and scored at once, a block within
+    # CPU cache is scored faster than one streamed from memory
+    BLOCK_BYTES = 1 << 20
+
+    def __init__(
+            self,
+            ids: np.ndarray,
+            codes: np.ndarray,
+            scales: np.ndarray,
+            quantization: str):
+        self.ids = ids
+        self.codes = codes
+        self.scales = scales
+        self.quantization = quantization
+
+    @classmethod
+    def from_vectors(
+            cls,
+            ids: list,
+            vectors: np.ndarray,
+            quantization: str) -> 'QuantizedIndex':
+        codes, scales = quantize(normalized(vectors), quantization)
+        return cls(np.asarray(ids), codes, scales, quantization)
+
+    # build from embeddings of collection, paged to bound memory of results
+    @classmethod
+    def from_collection(
+            cls,
+            collection,
+            quantization: str,
+            page_size: int = 10000) -> 'QuantizedIndex':
+        ids, codes, scales = [], [], []
+        for offset in range(0, collection.count(), page_size):
+            page = collection.get(include=['embeddings'], limit=page_size, offset=offset)
+            if not page['ids']:
+                break
+            page_codes, page_scales = quantize(normalized(page['embeddings']), quantization)
+            ids.extend(page['ids'])
+            codes.append(page_codes)
+            scales.append(page_scales)
+        if not ids:
+            return cls.from_vectors([], np.zeros((0, 0), dtype=np.float32), quantization)
+        return cls(np.asarray(ids), np.concatenate(codes), np.concatenate(scales), quantization)
+
+    @classmethod
+    def load(cls, filepath: str) -> 'QuantizedIndex':
+        with np.load(filepath) as data:
+            return cls(data['ids'], data['codes'], data['scales'], str(data['quantization']))
+
+    # save to a temporary file first, so readers never see a partial index
+    def save(self, filepath: str):
+        tmp_filepath = f'{filepath}.tmp.npz'
+        np.savez(
+            tmp_filepath,
+            ids=self.ids,
+            codes=self.codes,
+            scales=self.scales,
+            quantization=self.quantization)
+        os.replace(tmp_filepath, filepath)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes
+
+    @property
+    def dimensions(self) -> int:
+        return self.codes.shape[1] if self.codes.ndim == 2 else 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    # approximate top k ids and cosine similarities of query vector
+    def search(self, vector, k: int) -> tuple:
+        if not len(self.ids):
+            return [], np.zeros(0, dtype=np.float32)
+        query = normalized(vector)
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        block_size = max(self.BLOCK_BYTES // (self.dimensions * 4), 1)
+        for start in range(0, len(self.ids), block_size):
+            block = self.codes[start:start + block_size]
+            scores[start:start + len(block)] = \
+                (block.astype(np.float32) @ query) * self.scales[start:start + len(block)]
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return self.ids[top].tolist(), scores[top]
+
+
+# side index configured by environment variable, None if disabled
+def side_index_quantization() -> str:
+    quantization = os.environ.get('VECTOR_QUANTIZATION', '').lower()
+    if quantization in ('', 'none', 'float32'):
+        return None
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(
+            f'Unknown VECTOR_QUANTIZATION {quantization}, expected one of {QUANTIZATIONS}')
+    return quantization
+
+
+# build side index of collection and save it next to vectorstore
+def build_side_index(
+        collection,
+        vectorstore_filepath: str,
+        collection_name: str,
+        quantization: str) -> QuantizedIndex:
+    index = QuantizedIndex.from_collection(collection, quantization)
+    filepath = side_index_filepath(vectorstore_filepath, collection_name, quantization)
+    index.save(filepath)
+    logger.info(
+        f'Built {quantization} side index {filepath} of {len(index)} vectors with '
+        f'{index.dimensions} dimensions, {index.nbytes / 1024 / 1024:.1f} MB')
+    return index
@@ -0,0 +1,98 @@
+# A loader of Word documents in a directory, files are parsed in a process
+# pool and extracted text is kept in a parse cache, so unchanged files are
+# never parsed twice. Documents are yielded in file order, as DirectoryLoader
+
+import os
+import glob
+import logging
+import collections
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterator
+
+from tqdm import tqdm
+
+from util.parse_cache import ParseCache
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+# worker function of process pool, parse text of a Word document,
+# legacy .doc may be converted by an external converter
+def _parse(filepath: str) -> str:
+    from langchain_community.document_loaders import UnstructuredWordDocumentLoader
+
+    return '\n\n'.join(
+        doc.page_content for doc in UnstructuredWordDocumentLoader(filepath).load())
+
+
+class WordDirectoryLoader:
+    def __init__(
+            self,
+            path: str,
+            glob: str = '*.doc*',
+            cache_filepath: str = None,
+            max_workers: int = None):
+        self.path = path
+        self.glob = glob
+        self.cache = ParseCache(cache_filepath or os.environ.get(
+            'PARSE_CACHE_FILEPATH', 'assets/cache/parsed.sqlite3'))
+        self.max_workers = max_workers or int(
+            os.environ.get('PARSE_WORKERS', os.cpu_count() or 1))
+
+    # files to be loaded, hidden files are skipped as DirectoryLoader
+    def _filepaths(self) -> list[str]:
+        return sorted(
+            filepath for filepath in glob.glob(os.path.join(self.path, self.glob))
+            if os.path.isfile(filepath) and not os.path.basename(filepath).startswith('.'))
+
+    # look up parse cache, or submit file to be parsed by workers
+    def _submit(self, executor: ProcessPoolExecutor, filepath: str) -> tuple:
+        text, sha256 = self.cache.get(filepath)
+        if text is None:
+            return filepath, sha256, executor.submit(_parse, filepath)
+        return filepath, sha256, text
+
+    # wait for parsed text and keep it in cache, return None if failed
+    def _result(self, entry: tuple):
+        from langchain_core.documents import Document
+
+        filepath, sha256, text = entry
+        if isinstance(text, Future):
+            try:
+                text = text.result()
+            except Exception as e:
+                logger.error(f'Parse {filepath} with error: {e}')
+                return None
+            self.cache.put(filepath, sha256, text)
+        # content hash of file, to sync directory with indexed documents
+        return Document(page_content=text, metadata={'source': filepath, 'source_hash': sha256})
+
+    # content hash of each file, cached files are hashed only if changed
+    def file_hashes(self) -> dict:
+        return {filepath: self.cache.hash(filepath) for filepath in self._filepaths()}
+
+    # load files, or only given files
+    def lazy_load(self, filepaths: list[str] = None) -> Iterator:
+        filepaths = self._filepaths() if filepaths is None else sorted(filepaths)
+        # spawn workers, loader may run in a thread of pipeline
+        with ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn')) as executor:
+            # a window of files in order, missing files are parsed ahead by
+            # workers, bounded to keep memory of parsed text small
+            window = collections.deque()
+            parsed = 0
+            for filepath in tqdm(filepaths):
+                window.append(self._submit(executor, filepath))
+                parsed += isinstance(window[-1][2], Future)
+                while window and (
+                        len(window) > self.max_workers * 2 or not isinstance(window[0][2], Future)):
+                    if (document := self._result(window.popleft())) is not None:
+                        yield document
+            while window:
+                if (document := self._result(window.popleft())) is not None:
+                    yield document
+        logger.info(
+            f'Loaded {len(filepaths)} files from {self.path}, {parsed} parsed, {len(filepaths) - parsed} from cache')
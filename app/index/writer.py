@@ -0,0 +1,99 @@
+# A single writer of a vectorstore collection. Embedding tasks only produce
+# (id, vector, metadata, text) records, and one writer thread upserts them
+# in large batches, so the SQLite and HNSW files of a collection are never
+# touched by concurrent writers
+
+import queue
+import hashlib
+import logging
+import threading
+from typing import Callable
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+# a stable chunk id derived from source and content, so re-embedding the
+# same chunk overwrites it instead of adding a duplicate
+def chunk_id(source: str, text: str) -> str:
+    return hashlib.sha256(f'{source}\x00{text}'.encode('utf-8')).hexdigest()[:32]
+
+
+class VectorStoreWriter:
+    # sentinel to stop writer thread
+    _STOP = object()
+
+    def __init__(
+            self,
+            collection,
+            batch_size: int = 5000,
+            queue_size: int = 64,
+            flush_interval: float = 5.0,
+            on_written: Callable[[list], None] = None,
+            on_failed: Callable[[list, Exception], None] = None):
+        self.collection = collection
+        # callbacks with ids of written or failed records, e.g. checkpoint
+        self.on_written = on_written
+        self.on_failed = on_failed
+        # chroma limits number of records in one call
+        max_batch_size = getattr(collection._client, 'max_batch_size', None)
+        self.batch_size = min(batch_size, max_batch_size or batch_size)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flush_interval = flush_interval
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.written = 0
+        self.failed = []
+
+    def start(self) -> 'VectorStoreWriter':
+        self.thread.start()
+        return self
+
+    # enqueue records, block if writer falls behind
+    def put(self, records: list[tuple]):
+        self.queue.put(records)
+
+    # stop writer after pending records are written
+    def close(self):
+        self.queue.put(self._STOP)
+        self.thread.join()
+        logger.info(
+            f'Written {self.written} records to collection {self.collection.name}, {len(self.failed)} failed')
+
+    def _flush(self, pending: dict):
+        if not pending:
+            return
+        ids = list(pending)
+        vectors, metadatas, texts = zip(*pending.values())
+        try:
+            self.collection.upsert(
+                ids=ids,
+                embeddings=list(vectors),
+                metadatas=list(metadatas),
+                documents=list(texts))
+            self.written += len(ids)
+            if self.on_written:
+                self.on_written(ids)
+        except Exception as e:
+            logger.error(f'Upsert {len(ids)} records to {self.collection.name} with error: {e}')
+            self.failed.extend(ids)
+            if self.on_failed:
+                self.on_failed(ids, e)
+        pending.clear()
+
+    def _run(self):
+        # keyed by id, a duplicated id in one upsert is rejected by chroma
+        pending = {}
+        while True:
+            try:
+                records = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                # flush when idle, so progress is persisted
+                self._flush(pending)
+                continue
+            if records is self._STOP:
+                self._flush(pending)
+                return
+            for id, vector, metadata, text in records:
+                pending[id] = (vector, metadata, text)
+                if len(pending) >= self.batch_size:
+                    self._flush(pending)
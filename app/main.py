@@ -1,4 +1,5 @@
 import os
+import sys
 import logging
 import argparse
 
@@ -11,122 +12,187 @@ import config.logging
 logger = logging.getLogger(__name__)
 
 
-# Transform law data for creating embeddings
-def transform_law():
-    from assets.transform import loader, transformer
+# Transform open data from source filepath into destination path,
+# articles of all categories are partitioned into shards by LawCategory
+def _transform(
+        src_filepath: str,
+        dst_path: str,
+        parallel: bool = False,
+        worker_count: int = None,
+        incremental: bool = False):
+    import time
+    from contextlib import nullcontext
+    from assets.transform import (
+        iter_loader,
+        transformer,
+        parallel_transformer,
+        ShardedJsonLinesWriter,
+        TransformManifest
+    )
+
+    # records are streamed from file one at a time
+    data = iter_loader(src_filepath)
+    logger.info(f'Streaming records from file {src_filepath}')
 
-    # transform law data
-    data = loader(os.environ.get('LAW_FILEPATH'))
-    logger.info(
-        f'Loaded {len(data)} records from file {os.environ.get("LAW_FILEPATH")}')
+    # create full path if not exists
+    os.makedirs(dst_path, exist_ok=True)
+    # name shards and index with file name of source filepath
+    name = os.path.splitext(os.path.basename(src_filepath))[0]
+
+    # compare with manifest of previous run and write added, changed and
+    # removed articles to a delta file, which is applied by embeddings
+    manifest = None
+    if incremental:
+        manifest = TransformManifest(
+            os.path.join(dst_path, f'{name}.manifest'),
+            os.path.join(dst_path, f'{name}.{time.strftime("%Y%m%d%H%M%S")}.delta'))
+
+    with manifest or nullcontext(), ShardedJsonLinesWriter(dst_path, name) as writer:
+        if parallel:
+            # transform across a process pool
+            count = parallel_transformer(
+                data,
+                writer,
+                worker_count=worker_count,
+                manifest=manifest)
+        else:
+            count = transformer(
+                data,
+                writer,
+                manifest=manifest)
+    logger.info(f'Transformed {count} records into {dst_path}')
 
-    collection = transformer(
-        data,
-        allowed_category=['行政＞衛生福利部', '行政＞農業部'])
-    logger.info(f'Transformed {len(collection.data)} records')
 
+# Transform law data for creating embeddings
+def transform_law(
+        parallel: bool = False,
+        worker_count: int = None,
+        incremental: bool = False):
     # get output path from env 'LAW_TRANSFORMED_PATH'
-    path = os.environ.get('LAW_TRANSFORMED_PATH')
-    # create full path if not exists
-    os.makedirs(path, exist_ok=True)
-    # join path with file name of 'LAW_FILEPATH'
-    filepath = os.path.join(path, os.path.basename(
-        os.environ.get('LAW_FILEPATH')))
-    # write to file in JSON format
-    collection.to_json_file(
-        filepath, 'w',
-        ensure_ascii=False,
-        indent=4)
+    _transform(
+        os.environ.get('LAW_FILEPATH'),
+        os.environ.get('LAW_TRANSFORMED_PATH'),
+        parallel=parallel,
+        worker_count=worker_count,
+        incremental=incremental)
 
 
 # Transform order data for creating embeddings
-def transform_order():
-    from assets.transform import loader, transformer
-
-    # transform order data
-    data = loader(os.environ.get('ORDER_FILEPATH'))
-    logger.info(
-        f'Loaded {len(data)} records from file {os.environ.get("ORDER_FILEPATH")}')
-
-    collection = transformer(
-        data,
-        allowed_category=['行政＞衛生福利部', '行政＞農業部'])
-    logger.info(f'Transformed {len(collection.data)} records')
-
-    # get output file path from env 'ORDER_TRANSFORMED_PATH'
-    path = os.environ.get('ORDER_TRANSFORMED_PATH')
-    # create full path if not exists
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    # join path with file name of 'ORDER_FILEPATH'
-    filepath = os.path.join(path, os.path.basename(
-        os.environ.get('ORDER_FILEPATH')))
-    # write to file in JSON format
-    collection.to_json_file(
-        filepath, 'w',
-        ensure_ascii=False,
-        indent=4)
-
-
-# Create law embeddings
-def create_law_embeddings():
+def transform_order(
+        parallel: bool = False,
+        worker_count: int = None,
+        incremental: bool = False):
+    # get output path from env 'ORDER_TRANSFORMED_PATH'
+    _transform(
+        os.environ.get('ORDER_FILEPATH'),
+        os.environ.get('ORDER_TRANSFORMED_PATH'),
+        parallel=parallel,
+        worker_count=worker_count,
+        incremental=incremental)
+
+
+# Run embeddings, rebuild side and lexical indexes of the collection, and
+# renew its build id if the collection is changed, return False if the run
+# failed, e.g. exceeding max cost, cancelled or failed batches
+def _run(embeddings) -> bool:
+    try:
+        if embeddings.run():
+            embeddings.build_side_index()
+            embeddings.build_lexical_index()
+    finally:
+        # invalidate cached answers of the collection whenever it is changed,
+        # including chunks written or deleted by a failed run
+        if embeddings.modified:
+            embeddings.renew_build_id()
+    return not embeddings.failed
+
+
+# Create law embeddings of category shards
+def create_law_embeddings(
+        delta: bool = False,
+        resume: bool = False,
+        max_cost: float = None,
+        categories: list[str] = ['行政＞衛生福利部', '行政＞農業部']) -> bool:
     from index.embeddings import LawEmbeddings
 
-    LawEmbeddings(
+    return _run(LawEmbeddings(
         os.environ.get('LAW_TRANSFORMED_PATH'),
         os.environ.get('EMBEDDINGS_TAIWAN_LAW_FILEPATH'),
         collection_name=os.environ.get(
             'EMBEDDINGS_TAIWAN_LAW_COLLECTION_NAME'),
-        chunk_size=800,
-        chunk_overlap=100
-    ).run()
-
-
-# Create order embeddings
-def create_order_embeddings():
+        chunk_size=512,
+        chunk_overlap=64,
+        delta=delta,
+        categories=categories,
+        resume=resume,
+        max_cost=max_cost
+    ))
+
+
+# Create order embeddings of category shards
+def create_order_embeddings(
+        delta: bool = False,
+        resume: bool = False,
+        max_cost: float = None,
+        categories: list[str] = ['行政＞衛生福利部', '行政＞農業部']) -> bool:
     from index.embeddings import LawEmbeddings
 
-    LawEmbeddings(
+    return _run(LawEmbeddings(
         os.environ.get('ORDER_TRANSFORMED_PATH'),
         os.environ.get('EMBEDDINGS_TAIWAN_LAW_FILEPATH'),
         collection_name=os.environ.get(
             'EMBEDDINGS_TAIWAN_LAW_COLLECTION_NAME'),
-        chunk_size=800,
-        chunk_overlap=100
-    ).run()
+        chunk_size=512,
+        chunk_overlap=64,
+        delta=delta,
+        categories=categories,
+        resume=resume,
+        max_cost=max_cost
+    ))
 
 
 # Create investigation report embeddings
-def create_investigation_embeddings():
+def create_investigation_embeddings(
+        sync: bool = False,
+        resume: bool = False,
+        max_cost: float = None) -> bool:
     from index.embeddings import InvestigationReportEmbeddings
 
-    InvestigationReportEmbeddings(
+    return _run(InvestigationReportEmbeddings(
         os.environ.get('INVESTIGATION_REPORTS_PATH'),
         os.environ.get('EMBEDDINGS_INVESTIGATION_REPORTS_FILEPATH'),
         collection_name=os.environ.get(
             'EMBEDDINGS_INVESTIGATION_REPORTS_COLLECTION_NAME'),
-        chunk_size=800,
-        chunk_overlap=100
-    ).run()
+        chunk_size=512,
+        chunk_overlap=64,
+        sync=sync,
+        resume=resume,
+        max_cost=max_cost
+    ))
 
 
 # Create news embeddings
-def create_news_embeddings():
+def create_news_embeddings(
+        sync: bool = False,
+        resume: bool = False,
+        max_cost: float = None) -> bool:
     from index.embeddings import NewsEmbeddings
 
-    NewsEmbeddings(
+    return _run(NewsEmbeddings(
         os.environ.get('NEWS_PATH'),
         os.environ.get('EMBEDDINGS_NEWS_FILEPATH'),
         collection_name=os.environ.get(
             'EMBEDDINGS_NEWS_COLLECTION_NAME'),
-        chunk_size=800,
-        chunk_overlap=100
-    ).run()
+        chunk_size=512,
+        chunk_overlap=64,
+        sync=sync,
+        resume=resume,
+        max_cost=max_cost
+    ))
 
 
-# Return indexer base on target name
-def get_indexer(target_name: str):
-    from query.embeddings import QueryEmbeddings
-
+# Return vectorstore filepath and collection name base on target name
+def _vectorstore(target_name: str) -> tuple:
     if target_name == 'investigation':
         vectorstore_filepath = os.environ.get(
             'EMBEDDINGS_INVESTIGATION_REPORTS_FILEPATH')
@@ -141,7 +207,14 @@ def get_indexer(target_name: str):
         vectorstore_filepath = os.environ.get('EMBEDDINGS_TAIWAN_LAW_FILEPATH')
         collection_name = os.environ.get(
             'EMBEDDINGS_TAIWAN_LAW_COLLECTION_NAME')
+    return vectorstore_filepath, collection_name
+
+
+# Return indexer base on target name
+def get_indexer(target_name: str):
+    from query.embeddings import QueryEmbeddings
 
+    vectorstore_filepath, collection_name = _vectorstore(target_name)
     return QueryEmbeddings(
         vectorstore_filepath=vectorstore_filepath,
         collection_name=collection_name)
@@ -152,11 +225,16 @@ def get_relevant_documents_by_query(
         query: str,
         target_name: str = 'law',
         method: str = 'similarity_search'):
+    from util.normalize import normalize
+
     # check if query is empty or string
     if not isinstance(query, str):
         logger.error(f'Query is not a string: {query}')
         return "Please provide a query."
 
+    # normalize query the same way as documents
+    query = normalize(query)
+
     indexer = get_indexer(target_name)
 
     # similarity search
@@ -166,6 +244,10 @@ def get_relevant_documents_by_query(
     elif method == 'simple_query':
         retriever = indexer.as_retriever()
         search_results = retriever.invoke(query)
+    # fuse vector and lexical search
+    elif method == 'hybrid_query':
+        retriever = indexer.as_hybrid_retriever()
+        search_results = retriever.invoke(query)
     # elif method == 'multi_query':
     else:
         retriever = indexer.as_multiquery_retriever()
@@ -174,6 +256,15 @@ def get_relevant_documents_by_query(
     return search_results
 
 
+# Get chunks by id from chunk stores of law or investigation report
+def get_chunks_by_ids(
+        ids: list[str],
+        target_name: str = 'law') -> dict:
+    from index.chunk_store import chunk_stores, get_chunks
+
+    return get_chunks(chunk_stores(*_vectorstore(target_name)), ids)
+
+
 # Function to get relevant documents by a website
 def get_relevant_documents_by_website(site_link: str):
     from query import web, summary
@@ -197,13 +288,17 @@ def retrieval_qa(
         query: str,
         target_name: str = 'law'):
     from query import qa
-    from util.openai import chatter
+    from util.normalize import normalize
+    from util.openai import answer_cache, chatter
 
     # check if query is empty or string
     if not isinstance(query, str):
         logger.error(f'Query is not a string: {query}')
         return "Please provide a query."
 
+    # normalize query the same way as documents
+    query = normalize(query)
+
     indexer = get_indexer(target_name=target_name)
 
     # determin chain type by target name
@@ -214,7 +309,9 @@ def retrieval_qa(
         llm=chatter(),
         chain_type=chain_type,
         retriever=indexer.as_multiquery_retriever(),
-        return_source_documents=True)
+        return_source_documents=True,
+        answer_cache=answer_cache(),
+        indexer=indexer)
 
     search_results = rqa.query({"query": query})
 
@@ -231,18 +328,47 @@ if __name__ == '__main__':
     parser.add_argument('--transform-law-n-order',
                         action='store_true',
                         help='transform law and order data for creating embeddings')
+    # --transform-jsonl is kept as an alias, as every transform writes JSON lines shards now
+    parser.add_argument('--transform-parallel',
+                        '--transform-jsonl',
+                        action='store_true',
+                        help='transform with a process pool')
+    parser.add_argument('--transform-workers',
+                        type=int,
+                        default=None,
+                        help='number of transform workers, default to CPU count minus one')
+    parser.add_argument('--transform-incremental',
+                        action='store_true',
+                        help='write added, changed and removed articles since previous transform to a delta file')
     parser.add_argument('--create-law-embeddings',
                         action='store_true',
                         help='create law embeddings')
     parser.add_argument('--create-order-embeddings',
                         action='store_true',
                         help='create order embeddings')
+    parser.add_argument('--delta',
+                        action='store_true',
+                        help='apply pending delta files of incremental transform to law and order embeddings')
+    parser.add_argument('--categories',
+                        type=str,
+                        nargs='*',
+                        default=['行政＞衛生福利部', '行政＞農業部'],
+                        help='law categories to create law and order embeddings, all categories if empty')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='resume previous embeddings run, skip written chunks and retry failed batches')
+    parser.add_argument('--max-cost',
+                        type=float,
+                        help='proceed without confirmation if estimated embedding cost in USD is within max cost, otherwise exit')
     parser.add_argument('--create-investigation-embeddings',
                         action='store_true',
                         help='create investigation report embeddings')
     parser.add_argument('--create-news-embeddings',
                         action='store_true',
                         help='create news embeddings')
+    parser.add_argument('--sync',
+                        action='store_true',
+                        help='embed only new and changed files, and delete removed files from investigation and news embeddings')
     # get relevant documents by query
     parser.add_argument('--target-name',
                         type=str,
@@ -254,27 +380,54 @@ if __name__ == '__main__':
                         choices=[
                             'similarity_search',
                             'simple_query',
+                            'hybrid_query',
                             'multi_query'],
                         default='similarity_search',
                         help='query method')
     parser.add_argument('--query', type=str, help='query string')
+    parser.add_argument('--chunk-ids',
+                        type=str,
+                        nargs='+',
+                        help='get chunks by id from chunk stores of query target')
     parser.add_argument('--qa', type=str, help='query string by Retrieval QA')
     # get html text from a website
     parser.add_argument('--crawler', type=str, help='crawl a website')
 
     args = parser.parse_args()
+    # embeddings runs failed, exit with an error for scheduled jobs
+    failed = []
 
     if args.transform_law_n_order:
-        transform_law()
-        transform_order()
-    if args.create_law_embeddings:
-        create_law_embeddings()
-    if args.create_order_embeddings:
-        create_order_embeddings()
-    if args.create_investigation_embeddings:
-        create_investigation_embeddings()
-    if args.create_news_embeddings:
-        create_news_embeddings()
+        transform_law(
+            parallel=args.transform_parallel,
+            worker_count=args.transform_workers,
+            incremental=args.transform_incremental)
+        transform_order(
+            parallel=args.transform_parallel,
+            worker_count=args.transform_workers,
+            incremental=args.transform_incremental)
+    if args.create_law_embeddings and not create_law_embeddings(
+            delta=args.delta,
+            categories=args.categories,
+            resume=args.resume,
+            max_cost=args.max_cost):
+        failed.append('law')
+    if args.create_order_embeddings and not create_order_embeddings(
+            delta=args.delta,
+            categories=args.categories,
+            resume=args.resume,
+            max_cost=args.max_cost):
+        failed.append('order')
+    if args.create_investigation_embeddings and not create_investigation_embeddings(
+            sync=args.sync,
+            resume=args.resume,
+            max_cost=args.max_cost):
+        failed.append('investigation')
+    if args.create_news_embeddings and not create_news_embeddings(
+            sync=args.sync,
+            resume=args.resume,
+            max_cost=args.max_cost):
+        failed.append('news')
     if args.query:
         search_results = get_relevant_documents_by_query(
             query=args.query,
@@ -282,6 +435,11 @@ if __name__ == '__main__':
             method=args.method,)
         print('\n===== Relevant documents =====\n')
         print(search_results)
+    if args.chunk_ids:
+        chunks = get_chunks_by_ids(
+            ids=args.chunk_ids,
+            target_name=args.target_name,)
+        print(chunks)
     if args.qa:
         search_results = retrieval_qa(
             query=args.qa,
@@ -290,3 +448,6 @@ if __name__ == '__main__':
     if args.crawler:
         search_results = get_relevant_documents_by_website(args.crawler)
         print(search_results)
+    if failed:
+        logger.error(f'Embeddings of {", ".join(failed)} failed')
+        sys.exit(1)
@@ -1,8 +1,11 @@
+import os
 import logging
-from typing import Union, List
+from typing import Any, Union, List
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
 
-from util.openai import embedder, chatter
+from util.openai import cached_query_embedder, chatter, query_variant_cache
 
 # Get logger
 logger = logging.getLogger(__name__)
@@ -17,6 +20,12 @@ class QueryEmbeddings:
         import chromadb
         from langchain_community.vectorstores import Chroma
 
+        self.vectorstore_filepath = vectorstore_filepath
+        self.collection_name = collection_name
+        # build id read before loading, so a rebuild while loading is
+        # noticed by registry
+        self.loaded_build_id = self.build_id()
+
         # load vector store with single collection from disk
         self.vdb = chromadb.PersistentClient(
             path=vectorstore_filepath)
@@ -27,23 +36,157 @@ class QueryEmbeddings:
         self.store = Chroma(
             client=self.vdb,
             collection_name=collection_name,
-            embedding_function=embedder())
+            embedding_function=cached_query_embedder())
         logger.info(
             f'There are {self.store._collection.count()} in the collection {collection_name}')
 
+        # chunk stores of the collection, opened on first lookup
+        self.chunk_stores = None
+
+        # quantized side index for first-pass search, if built
+        self.side_index = self._load_side_index(vectorstore_filepath, collection_name)
+        # candidates of first pass rescored with full-precision vectors
+        self.rescore_factor = int(os.environ.get('VECTOR_RESCORE_FACTOR', 4))
+        # lexical index of chunks for hybrid search, if built
+        self.lexical_index = self._load_lexical_index(vectorstore_filepath, collection_name)
+
+    # load vector index into memory ahead of first query, HNSW index of
+    # collection is loaded lazily by chromadb, and not used with side index
+    def warm_up(self):
+        if self.side_index is not None:
+            return
+        peek = self.store._collection.peek(limit=1)
+        if len(peek['ids']):
+            self.store._collection.query(
+                query_embeddings=[list(peek['embeddings'][0])],
+                n_results=1)
+
+    def _load_side_index(
+            self,
+            vectorstore_filepath: str,
+            collection_name: str):
+        from index.quantized import QuantizedIndex, side_index_filepath, side_index_quantization
+
+        quantization = side_index_quantization()
+        if quantization is None:
+            return None
+        filepath = side_index_filepath(vectorstore_filepath, collection_name, quantization)
+        if not os.path.exists(filepath):
+            logger.warning(f'Side index {filepath} not found, search by collection instead')
+            return None
+        side_index = QuantizedIndex.load(filepath)
+        logger.info(
+            f'Loaded {quantization} side index {filepath} of {len(side_index)} vectors, '
+            f'{side_index.nbytes / 1024 / 1024:.1f} MB')
+        return side_index
+
+    def _load_lexical_index(
+            self,
+            vectorstore_filepath: str,
+            collection_name: str):
+        from index.lexical import LexicalIndex, lexical_index_enabled, lexical_index_filepath
+
+        if not lexical_index_enabled():
+            return None
+        filepath = lexical_index_filepath(vectorstore_filepath, collection_name)
+        if not os.path.exists(filepath):
+            logger.warning(f'Lexical index {filepath} not found, search by vectors only')
+            return None
+        lexical_index = LexicalIndex(filepath)
+        logger.info(f'Loaded lexical index {filepath} of {len(lexical_index)} chunks')
+        return lexical_index
+
+    # first pass over quantized side index, and rescore top candidates with
+    # full-precision vectors of collection, scores are relevance scores of
+    # the vectorstore, so score threshold means the same with or without
+    def _side_index_search(
+            self,
+            vector: List[float],
+            k: int,
+            score_threshold: float) -> List[tuple]:
+        import numpy as np
+        from index.quantized import normalized
+
+        vector = normalized(vector)
+        ids, _ = self.side_index.search(vector, k * self.rescore_factor)
+        if not ids:
+            return []
+        candidates = self.store._collection.get(
+            ids=ids, include=['embeddings', 'documents', 'metadatas'])
+        vectors = np.asarray(candidates['embeddings'], dtype=np.float32)
+        similarities = normalized(vectors) @ vector
+        # distance of the collection space, l2 is squared as in chroma
+        space = (self.store._collection.metadata or {}).get('hnsw:space', 'l2')
+        if space == 'l2':
+            distances = np.sum((vectors - vector) ** 2, axis=1)
+        else:
+            distances = 1 - similarities
+        relevance_score_fn = self.store._select_relevance_score_fn()
+
+        results = []
+        for i in np.argsort(-similarities)[:k]:
+            score = relevance_score_fn(float(distances[i]))
+            if score < score_threshold:
+                continue
+            results.append((
+                Document(
+                    page_content=candidates['documents'][i],
+                    metadata=candidates['metadatas'][i] or {}),
+                score))
+        return results
+
+    # similar documents and relevance scores of an embedded query
+    def search_by_vector(
+            self,
+            vector: List[float],
+            top_k: int = 4,
+            score_threshold: float = 0.3) -> List[tuple]:
+        if self.side_index is not None:
+            return self._side_index_search(vector, top_k, score_threshold)
+        # scores of vectorstore are distances, converted to relevance scores
+        relevance_score_fn = self.store._select_relevance_score_fn()
+        results = [
+            (doc, relevance_score_fn(distance))
+            for doc, distance in self.store.similarity_search_by_vector_with_relevance_scores(
+                vector, k=top_k)]
+        return [(doc, score) for doc, score in results if score >= score_threshold]
+
+    # documents and BM25 scores matching terms of query in lexical index,
+    # chunks are read from chunk stores, empty without lexical index
+    def lexical_search(
+            self,
+            query: str,
+            top_k: int = 4) -> List[tuple]:
+        if self.lexical_index is None:
+            return []
+        ids, scores = self.lexical_index.search(query, top_k)
+        chunks = self.get_chunks(ids)
+        return [
+            (Document(page_content=chunks[id]['text'], metadata=chunks[id]['metadata'] or {}), score)
+            for id, score in zip(ids, scores) if id in chunks]
+
     # function to query similar documents
     def similarity_search(
             self,
             query: str,
-            score_threshold: float = 0.3) -> Union[str, List[dict]]:
+            score_threshold: float = 0.3,
+            top_k: int = 4) -> Union[str, List[dict]]:
         if not query:
             return "Please provide a query."
 
+        if self.side_index is not None:
+            search_results = self.search_by_vector(
+                self.store.embeddings.embed_query(query), top_k, score_threshold)
+            logger.info(
+                f'Found {len(search_results)} similar documents by side index with query: {query}')
+            return search_results
+
         # the data structure of search_results is
         # a list of SearchResult objects along with scores
         # search_results = self.store.similarity_search_with_score(query)
         search_results = self.store.similarity_search_with_relevance_scores(
             query,
+            k=top_k,
             score_threshold=score_threshold,)
         # search_results = self.store.similarity_search(query)
         logger.info(
@@ -51,11 +194,36 @@ class QueryEmbeddings:
 
         return search_results
 
+    # hits, misses and hit rate of query embedding cache, shared by indexers
+    def embedding_cache_stats(self) -> dict:
+        return self.store.embeddings.stats()
+
+    # build id of collection, read on every call so a rebuild is noticed
+    # by a running app
+    def build_id(self) -> str:
+        from index.build import read_build_id
+
+        return read_build_id(self.vectorstore_filepath, self.collection_name)
+
+    # function to get chunks by id from chunk stores written at ingestion,
+    # without round-tripping through the vectorstore
+    def get_chunks(self, ids: List[str]) -> dict:
+        from index.chunk_store import chunk_stores, get_chunks
+
+        if self.chunk_stores is None:
+            self.chunk_stores = chunk_stores(self.vectorstore_filepath, self.collection_name)
+        return get_chunks(self.chunk_stores, ids)
+
     # function to return retriever
     def as_retriever(
             self,
             score_threshold: float = 0.3,
             top_k: int = 10) -> BaseRetriever:
+        if self.side_index is not None:
+            return SideIndexRetriever(
+                indexer=self,
+                score_threshold=score_threshold,
+                top_k=top_k)
         return self.store.as_retriever(
             search_type='similarity_score_threshold',
             search_kwargs={
@@ -63,13 +231,27 @@ class QueryEmbeddings:
                 "k": top_k,},
         )
 
-    # function to return multiquery retriever
-    def as_multiquery_retriever(
+    # function to return hybrid retriever fusing vector and lexical search
+    def as_hybrid_retriever(
             self,
             score_threshold: float = 0.3,
             top_k: int = 10) -> BaseRetriever:
+        from query.hybrid import HybridRetriever
+
+        return HybridRetriever(
+            indexer=self,
+            score_threshold=score_threshold,
+            top_k=top_k)
+
+    # function to return multiquery retriever, lexical search of the
+    # original question is fused only if lexical is set
+    def as_multiquery_retriever(
+            self,
+            score_threshold: float = 0.3,
+            top_k: int = 10,
+            lexical: bool = False) -> BaseRetriever:
         from langchain.prompts import PromptTemplate
-        from langchain.retrievers.multi_query import MultiQueryRetriever
+        from query.multi_query import FusionMultiQueryRetriever
 
         # (Tailored from MultiQueryRetriever) Default prompt
         DEFAULT_QUERY_PROMPT = PromptTemplate(
@@ -84,11 +266,31 @@ class QueryEmbeddings:
 
         llm = chatter()
 
-        return MultiQueryRetriever.from_llm(
-            retriever=self.store.as_retriever(
-                search_type='similarity_score_threshold',
-                search_kwargs={
-                    "score_threshold": score_threshold,
-                    "k": top_k, }),
+        return FusionMultiQueryRetriever.from_llm(
+            indexer=self,
             llm=llm,
-            prompt=DEFAULT_QUERY_PROMPT,)
\ No newline at end of file
+            prompt=DEFAULT_QUERY_PROMPT,
+            score_threshold=score_threshold,
+            top_k=top_k,
+            lexical=lexical,
+            variant_cache=query_variant_cache(),
+            collection_name=self.collection_name)
+
+
+# A retriever searching quantized side index of QueryEmbeddings
+class SideIndexRetriever(BaseRetriever):
+    indexer: Any
+    score_threshold: float = 0.3
+    top_k: int = 10
+
+    def _get_relevant_documents(
+            self,
+            query: str,
+            *,
+            run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        vector = self.indexer.store.embeddings.embed_query(query)
+        return [
+            doc for doc, _ in self.indexer.search_by_vector(
+                vector,
+                self.top_k,
+                self.score_threshold)]
@@ -0,0 +1,39 @@
+# A hybrid retriever which fuses dense search of the embedded query with
+# BM25 search of the lexical index by reciprocal rank fusion, so queries of
+# exact statute names, article numbers or agency names are found even if
+# their vectors fall below score threshold, without generating variants
+
+import logging
+from typing import Any, List
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from query.multi_query import reciprocal_rank_fusion
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+class HybridRetriever(BaseRetriever):
+    # QueryEmbeddings to be searched
+    indexer: Any
+    score_threshold: float = 0.3
+    top_k: int = 10
+    # constant of reciprocal rank fusion
+    rrf_k: int = 60
+
+    def _get_relevant_documents(
+            self,
+            query: str,
+            *,
+            run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        lexical = self.indexer.lexical_search(query, self.top_k)
+        vector = self.indexer.store.embeddings.embed_query(query)
+        dense = self.indexer.search_by_vector(vector, self.top_k, self.score_threshold)
+        fused = reciprocal_rank_fusion(
+            [[doc for doc, _ in dense], [doc for doc, _ in lexical]], k=self.rrf_k)
+        logger.info(
+            f'Fused {len(dense)} dense and {len(lexical)} lexical results into {len(fused)} documents')
+        return [doc for doc, _ in fused[:self.top_k]]
@@ -0,0 +1,121 @@
+# A multi-query retriever which embeds the original question and every
+# generated variant in one batched request, searches them concurrently,
+# and merges ranked results by reciprocal rank fusion, instead of embedding
+# and searching each variant in turn and taking a unique union
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from util.normalize import normalize
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+# identity of a retrieved document, chunks have no id in their metadata
+def document_key(doc: Document) -> tuple:
+    return doc.metadata.get('source'), doc.page_content
+
+
+# merge ranked lists of documents by reciprocal rank fusion, a document
+# scores the sum of 1 / (k + rank) over lists, so documents ranked high by
+# several queries come first, return documents with fused scores
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int = 60) -> List[tuple]:
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = document_key(doc)
+            documents.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return [
+        (documents[key], score)
+        for key, score in sorted(scores.items(), key=lambda item: item[1], reverse=True)]
+
+
+class FusionMultiQueryRetriever(BaseRetriever):
+    # QueryEmbeddings to be searched
+    indexer: Any
+    # chain of prompt, llm and parser to generate variants of question
+    llm_chain: Any
+    score_threshold: float = 0.3
+    top_k: int = 10
+    # constant of reciprocal rank fusion
+    rrf_k: int = 60
+    # fuse lexical search of the original question, opt-in as lexical hits
+    # are not bounded by score threshold
+    lexical: bool = False
+    # persistent cache of generated variants, keyed by question, target
+    # collection and prompt version, None if disabled
+    variant_cache: Any = None
+    collection_name: str = ''
+    prompt_version: str = ''
+
+    @classmethod
+    def from_llm(
+            cls,
+            indexer: Any,
+            llm: Any,
+            prompt: Any,
+            **kwargs) -> 'FusionMultiQueryRetriever':
+        from langchain.retrievers.multi_query import LineListOutputParser
+        from util.variant_cache import prompt_version
+
+        return cls(
+            indexer=indexer,
+            llm_chain=prompt | llm | LineListOutputParser(),
+            prompt_version=prompt_version(
+                prompt.template, getattr(llm, 'model_name', '')),
+            **kwargs)
+
+    # variants of question generated by llm, variants are deterministic at
+    # temperature 0, so cached variants are reused
+    def generate_queries(self, question: str) -> List[str]:
+        key = None
+        if self.variant_cache is not None:
+            key = self.variant_cache.key(question, self.collection_name, self.prompt_version)
+            queries = self.variant_cache.get(key)
+            if queries is not None:
+                logger.info(
+                    f'Cached queries: {queries}, hit rate {self.variant_cache.hit_rate():.1%}')
+                return queries
+
+        lines = self.llm_chain.invoke({'question': question})
+        queries = [line.strip() for line in lines if line.strip()]
+        logger.info(f'Generated queries: {queries}')
+        if key is not None and queries:
+            self.variant_cache.put(key, queries)
+        return queries
+
+    def _get_relevant_documents(
+            self,
+            query: str,
+            *,
+            run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        # the original question is normalized by caller, variants generated
+        # by LLM are normalized the same way as documents, and the original
+        # question is searched along with its variants
+        queries = list(dict.fromkeys(
+            [query] + [normalize(q) for q in self.generate_queries(query)]))
+        # one batched request embeds every query, cached queries are skipped
+        vectors = self.indexer.store.embeddings.embed_documents(queries)
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            results = list(executor.map(
+                lambda vector: self.indexer.search_by_vector(
+                    vector, self.top_k, self.score_threshold),
+                vectors))
+        # exact names and article numbers of the original question are
+        # matched by lexical index, if enabled and built
+        if self.lexical:
+            results.append(self.indexer.lexical_search(queries[0], self.top_k))
+        fused = reciprocal_rank_fusion(
+            [[doc for doc, _ in result] for result in results], k=self.rrf_k)
+        logger.info(
+            f'Fused {sum(len(result) for result in results)} results of {len(queries)} queries '
+            f'into {len(fused)} documents')
+        return [doc for doc, _ in fused[:self.top_k]]
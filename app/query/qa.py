@@ -1,5 +1,7 @@
 import logging
+from typing import Union
 from langchain.chains import RetrievalQA, ConversationalRetrievalChain
+from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
 
 # Get logger
@@ -51,13 +53,19 @@ class EmbeddingsRetrievalQA:
             llm,
             retriever: BaseRetriever,
             chain_type: str = 'stuff',
-            return_source_documents: bool = False):
+            return_source_documents: bool = False,
+            answer_cache=None,
+            indexer=None):
         from util import stuff_prompt, map_reduce_prompt, refine_prompt
 
         self.llm = llm
         self.retriever = retriever
         self.chain_type = chain_type
         self.return_source_documents = return_source_documents
+        # semantic cache of answers, and QueryEmbeddings searched by retriever
+        # to embed questions and invalidate answers of rebuilt collection
+        self.answer_cache = answer_cache if indexer is not None else None
+        self.indexer = indexer
 
         logger.info(
             f"EmbeddingsRetrievalQA: chain_type={chain_type}, return_source_documents={return_source_documents}")
@@ -99,12 +107,56 @@ class EmbeddingsRetrievalQA:
             return_source_documents=return_source_documents,
             verbose=True)
 
+    # target of cached answers, answers differ by collection, chain type,
+    # number and score threshold of retrieved documents, and lexical fusion
+    def _cache_target(self) -> str:
+        return (
+            f'{self.indexer.vectorstore_filepath}:{self.indexer.collection_name}:'
+            f'{self.chain_type}:{getattr(self.retriever, "top_k", "")}:'
+            f'{getattr(self.retriever, "score_threshold", "")}:'
+            f'{getattr(self.retriever, "lexical", "")}')
+
     # function to query by retrieval qa
-    def query(self, query: str) -> list[dict]:
+    def query(self, query: Union[str, dict]) -> list[dict]:
+        # accept question or inputs of chain
+        if isinstance(query, dict):
+            query = query.get('query')
         if not query:
             return "Please provide a query."
 
+        if self.answer_cache is None:
+            # get relevant documents
+            return self.qa({"query": query})
+
+        # similar questions of the same build reuse the cached answer, the
+        # question embedding is cached and reused by multi-query retriever
+        target = self._cache_target()
+        build = self.indexer.build_id()
+        vector = self.indexer.store.embeddings.embed_query(query)
+        cached = self.answer_cache.get(target, build, vector)
+        if cached is not None:
+            logger.info(
+                f'Cached answer of question: {cached["question"]}, similarity {cached["similarity"]:.3f}, '
+                f'hit rate {self.answer_cache.hit_rate():.1%}')
+            return {
+                "query": query,
+                "result": cached['answer'],
+                "source_documents": [Document(**source) for source in cached['sources']],
+            }
+
         # get relevant documents
         search_results = self.qa({"query": query})
 
+        if search_results.get('result'):
+            self.answer_cache.put(
+                target,
+                build,
+                query,
+                vector,
+                search_results['result'],
+                [
+                    {'page_content': doc.page_content, 'metadata': doc.metadata}
+                    for doc in search_results.get('source_documents', [])
+                ])
+
         return search_results
@@ -0,0 +1,84 @@
+# A process-wide registry of read-only indexers shared by every session of
+# the app, each indexer is loaded once on first use instead of per session,
+# and again once its collection is rebuilt, and memory footprint of each
+# collection is approximated while loading
+
+import time
+import logging
+import threading
+from typing import Any, Callable
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+class IndexerRegistry:
+    # seconds between checks of build id of a loaded collection
+    RECHECK_SECONDS = 5.0
+
+    def __init__(self, factory: Callable[[str], Any]):
+        # function to create indexer of target name, e.g. get_indexer
+        self.factory = factory
+        self.indexers = {}
+        self.footprints = {}
+        # last check of build id of each loaded collection
+        self.checked = {}
+        # loads are serialized, so a collection is never loaded twice
+        self.lock = threading.Lock()
+
+    # shared indexer of target name, loaded on first use, and reloaded if
+    # its collection is rebuilt, so side and lexical indexes are current
+    def get(self, target_name: str):
+        indexer = self.indexers.get(target_name)
+        if indexer is not None and not self._rebuilt(target_name, indexer):
+            return indexer
+        with self.lock:
+            # unless reloaded by another session meanwhile
+            if self.indexers.get(target_name) is indexer:
+                if indexer is not None:
+                    logger.info(f'Collection of indexer {target_name} is rebuilt, reload')
+                # sessions holding the previous indexer keep using it
+                self.indexers[target_name] = self._load(target_name)
+                self.checked[target_name] = time.monotonic()
+        return self.indexers[target_name]
+
+    # check if collection is rebuilt since indexer was loaded, build id is
+    # read at most once per recheck interval instead of on every lookup
+    def _rebuilt(self, target_name: str, indexer) -> bool:
+        now = time.monotonic()
+        if now - self.checked.get(target_name, 0.0) < self.RECHECK_SECONDS:
+            return False
+        self.checked[target_name] = now
+        return indexer.build_id() != indexer.loaded_build_id
+
+    def _load(self, target_name: str):
+        import psutil
+
+        # growth of resident memory of the process while loading, which
+        # approximates footprint of the collection, as other sessions may
+        # allocate meanwhile
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        start = time.perf_counter()
+        indexer = self.factory(target_name)
+        # load vector index ahead of first query
+        indexer.warm_up()
+        side_index = getattr(indexer, 'side_index', None)
+        self.footprints[target_name] = {
+            'collection': indexer.collection_name,
+            'vectors': indexer.store._collection.count(),
+            'rss_mb': (process.memory_info().rss - rss) / 1024 / 1024,
+            'side_index_mb': side_index.nbytes / 1024 / 1024 if side_index is not None else 0.0,
+            'load_seconds': time.perf_counter() - start,
+        }
+        logger.info(f'Loaded indexer {target_name}: {self.describe(target_name)}')
+        return indexer
+
+    # memory footprint of loaded collection in a line
+    def describe(self, target_name: str) -> str:
+        footprint = self.footprints[target_name]
+        return (
+            f'collection {footprint["collection"]} of {footprint["vectors"]} vectors, '
+            f'about {footprint["rss_mb"]:.1f} MB resident memory growth while loading, '
+            f'{footprint["side_index_mb"]:.1f} MB side index, '
+            f'loaded in {footprint["load_seconds"]:.1f}s')
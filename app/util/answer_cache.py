@@ -0,0 +1,129 @@
+# A semantic cache of answers of retrieval QA. A question is answered from
+# cache if a cached question of the same target and collection build is
+# similar enough by cosine similarity of their embeddings, and answers of
+# previous builds are dropped once the collection is rebuilt
+
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from array import array
+from typing import List
+
+import numpy as np
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+class AnswerCache:
+    def __init__(
+            self,
+            filepath: str,
+            threshold: float = 0.95,
+            max_entries: int = 1000):
+        self.filepath = filepath
+        # minimum cosine similarity of questions to reuse an answer
+        self.threshold = threshold
+        # max answers of each target, oldest are evicted
+        self.max_entries = max_entries
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # wait for lock, in case the cache is shared by processes
+        self.conn = sqlite3.connect(filepath, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS answers ('
+            'id INTEGER PRIMARY KEY, target TEXT NOT NULL, build TEXT NOT NULL, '
+            'question TEXT NOT NULL, vector BLOB NOT NULL, answer TEXT NOT NULL, '
+            'sources TEXT NOT NULL, created REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS answers_target ON answers (target, build)')
+        self.conn.commit()
+        # sessions of the app answer in threads
+        self.lock = threading.Lock()
+        # target to build, row ids and unit vectors of cached questions,
+        # rows added by other processes are loaded incrementally
+        self.vectors = {}
+        self.hits = 0
+        self.misses = 0
+
+    # unit vectors of cached questions of target and build, answers of
+    # other builds are dropped
+    def _load(self, target: str, build: str) -> tuple:
+        loaded = self.vectors.get(target)
+        if loaded is None or loaded[0] != build:
+            with self.conn:
+                deleted = self.conn.execute(
+                    'DELETE FROM answers WHERE target = ? AND build != ?', (target, build)).rowcount
+            if deleted:
+                logger.info(f'Dropped {deleted} cached answers of {target} of previous builds')
+            loaded = (build, np.zeros(0, dtype=np.int64), None)
+        _, ids, vectors = loaded
+        rows = self.conn.execute(
+            'SELECT id, vector FROM answers WHERE target = ? AND build = ? AND id > ? ORDER BY id',
+            (target, build, int(ids[-1]) if len(ids) else 0)).fetchall()
+        if rows:
+            added = np.asarray([array('f', row[1]) for row in rows], dtype=np.float32)
+            ids = np.concatenate([ids, np.asarray([row[0] for row in rows], dtype=np.int64)])
+            vectors = added if vectors is None else np.concatenate([vectors, added])
+        self.vectors[target] = (build, ids, vectors)
+        return ids, vectors
+
+    # cached answer of the most similar question above threshold, as dict of
+    # question, answer, sources and similarity, None if missing
+    def get(self, target: str, build: str, vector: List[float]) -> dict:
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        with self.lock:
+            ids, vectors = self._load(target, build)
+            row = None
+            if len(ids):
+                similarities = vectors @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    row = self.conn.execute(
+                        'SELECT question, answer, sources FROM answers WHERE id = ?',
+                        (int(ids[best]),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {
+            'question': row[0],
+            'answer': row[1],
+            'sources': json.loads(row[2]),
+            'similarity': float(similarities[best]),
+        }
+
+    # store answer of question, sources are dicts of page content and metadata,
+    # oldest answers of target beyond max entries are evicted
+    def put(
+            self,
+            target: str,
+            build: str,
+            question: str,
+            vector: List[float],
+            answer: str,
+            sources: List[dict]):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector /= max(float(np.linalg.norm(vector)), 1e-12)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO answers (target, build, question, vector, answer, sources, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (target, build, question, vector.tobytes(), answer,
+                 json.dumps(sources, ensure_ascii=False), time.time()))
+            evicted = self.conn.execute(
+                'DELETE FROM answers WHERE id IN ('
+                'SELECT id FROM answers WHERE target = ? ORDER BY id DESC LIMIT -1 OFFSET ?)',
+                (target, self.max_entries)).rowcount
+            if evicted:
+                # evicted rows are still in loaded vectors, reload them
+                self.vectors.pop(target, None)
+
+    # ratio of questions answered from cache
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -0,0 +1,174 @@
+# A persistent cache of embeddings, keyed by embedding model, dimensions
+# and hash of text, which is normalized by callers, so unchanged chunks are never embedded twice,
+# and repeated queries are never embedded twice
+
+import os
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import collections
+from array import array
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+# A cache of embeddings stored as float32 in SQLite
+class EmbeddingCache:
+    # maximum number of variables in one SQLite statement
+    BATCH_SIZE = 500
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # wait for lock, in case the cache is shared by processes
+        self.conn = sqlite3.connect(filepath, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)')
+        self.conn.commit()
+        # the connection is shared by asyncio.to_thread workers of ingestion
+        # and by threads of sessions of the app embedding queries
+        self.lock = threading.Lock()
+
+    # cache key of text embedded by model with dimensions
+    @staticmethod
+    def key(model: str, dimensions: int, text: str) -> str:
+        return hashlib.sha256(
+            f'{model}\x00{dimensions}\x00{text}'.encode('utf-8')).hexdigest()
+
+    # return cached vectors of keys, missing keys are not in result
+    def get_many(self, keys: List[str]) -> dict:
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), self.BATCH_SIZE):
+                batch = keys[i:i + self.BATCH_SIZE]
+                rows = self.conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?" * len(batch))})',
+                    batch)
+                for key, vector in rows:
+                    found[key] = array('f', vector).tolist()
+        return found
+
+    def put_many(self, items: dict):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)',
+                [(key, array('f', vector).tobytes()) for key, vector in items.items()])
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+
+# An embedding function which consults the cache before calling the
+# underlying embedding function, e.g. OpenAIEmbeddings, recently used
+# vectors are also kept in memory if memory size is given, e.g. queries
+class CachedEmbeddings(Embeddings):
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            cache: EmbeddingCache,
+            model: str,
+            dimensions: int = None,
+            memory_size: int = 0):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+        self.dimensions = dimensions
+        self.memory = collections.OrderedDict()
+        self.memory_size = memory_size
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.hits = 0
+        self.misses = 0
+
+    # look up memory and cache, return cached vectors and positions of missing texts
+    def _lookup(self, texts: List[str]) -> tuple:
+        keys = [self.cache.key(self.model, self.dimensions, text) for text in texts]
+        vectors = [None] * len(keys)
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    vectors[i] = self.memory[key]
+        memory_hits = sum(vector is not None for vector in vectors)
+        if memory_hits < len(keys):
+            found = self.cache.get_many([key for key, vector in zip(keys, vectors) if vector is None])
+            for i, key in enumerate(keys):
+                if vectors[i] is None:
+                    vectors[i] = found.get(key)
+            self._remember({key: found[key] for key in found})
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        with self.lock:
+            self.memory_hits += memory_hits
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        logger.debug(
+            f'Embedding cache hits {len(texts) - len(missing)} ({memory_hits} in memory), '
+            f'misses {len(missing)}, hit rate {self.hit_rate():.1%}')
+        return keys, vectors, missing
+
+    # keep recently used vectors in memory, least recently used are evicted
+    def _remember(self, items: dict):
+        if not self.memory_size:
+            return
+        with self.lock:
+            self.memory.update(items)
+            for key in items:
+                self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+    # ratio of texts found in memory or cache
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    # hits of memory and cache, misses and hit rate
+    def stats(self) -> dict:
+        return {
+            'memory_hits': self.memory_hits,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate(),
+        }
+
+    def _store(
+            self,
+            keys: List[str],
+            vectors: List,
+            missing: List[int],
+            embedded: List[List[float]]) -> List[List[float]]:
+        for i, vector in zip(missing, embedded):
+            vectors[i] = vector
+        items = {keys[i]: vectors[i] for i in missing}
+        self.cache.put_many(items)
+        self._remember(items)
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, missing = self._lookup(texts)
+        if not missing:
+            return vectors
+        embedded = self.embeddings.embed_documents([texts[i] for i in missing])
+        return self._store(keys, vectors, missing, embedded)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, missing = await asyncio.to_thread(self._lookup, texts)
+        if not missing:
+            return vectors
+        embedded = await self.embeddings.aembed_documents([texts[i] for i in missing])
+        return await asyncio.to_thread(self._store, keys, vectors, missing, embedded)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
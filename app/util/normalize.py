@@ -0,0 +1,87 @@
+# Normalize text in a single pass with precompiled translation tables,
+# the same normalization is shared by transform, indexing and query, and
+# each text is normalized once, articles by transform, documents of
+# directories at indexing, and a query when it enters the app, so documents
+# and queries always look alike to embeddings and caches
+
+import re
+
+# whitespace variants, e.g. CJK ideographic space and no-break space,
+# are replaced with normal space
+_SPACES = (
+    '\u00a0\u1680\u2000\u2001\u2002\u2003\u2004\u2005'
+    '\u2006\u2007\u2008\u2009\u200a\u202f\u205f\u3000')
+
+# zero width characters and byte order mark are removed
+_ZERO_WIDTH = '\u200b\u200c\u200d\u2060\ufeff'
+
+# box-drawing characters, e.g. ├, ─, ┼, ┤, │, from tables are removed
+_BOX_DRAWING = ''.join(chr(c) for c in range(0x2500, 0x2580))
+
+# punctuation variants are replaced with full-width form used by separators
+_PUNCTUATION = {
+    '﹐': '，',
+    '﹑': '、',
+    '﹒': '．',
+    '﹔': '；',
+    '﹕': '：',
+    '﹖': '？',
+    '﹗': '！',
+    '﹙': '（',
+    '﹚': '）',
+    '︰': '：',
+    '｡': '。',
+    '､': '、',
+    '｢': '「',
+    '｣': '」',
+}
+
+# full-width digits and latin letters are replaced with ASCII
+_FULL_WIDTH = {
+    chr(c): chr(c - 0xfee0)
+    for c in [*range(0xff10, 0xff1a), *range(0xff21, 0xff3b), *range(0xff41, 0xff5b)]
+}
+
+
+def _build_table(remove_space: bool) -> dict:
+    table = {}
+    table.update(str.maketrans(dict.fromkeys(_SPACES, ' ')))
+    table.update(str.maketrans(dict.fromkeys(_ZERO_WIDTH + _BOX_DRAWING)))
+    table.update(str.maketrans(_PUNCTUATION))
+    table.update(str.maketrans(_FULL_WIDTH))
+    if remove_space:
+        table[ord(' ')] = None
+    return table
+
+
+# a pattern to match runs of characters in translation table
+def _build_pattern(table: dict) -> re.Pattern:
+    return re.compile(
+        '[' + ''.join(re.escape(chr(c)) for c in sorted(table)) + ']+')
+
+
+# precompiled translation tables and patterns
+_TABLE = _build_table(remove_space=False)
+_TABLE_WITHOUT_SPACE = _build_table(remove_space=True)
+_PATTERN = _build_pattern(_TABLE)
+_PATTERN_WITHOUT_SPACE = _build_pattern(_TABLE_WITHOUT_SPACE)
+
+
+def _translate(match: re.Match) -> str:
+    return match.group().translate(_TABLE)
+
+
+def _translate_without_space(match: re.Match) -> str:
+    return match.group().translate(_TABLE_WITHOUT_SPACE)
+
+
+# normalize text in one pass, if remove_space is set, normal space is also
+# removed, other whitespace variants are still kept as a normal space
+def normalize(text: str, remove_space: bool = False) -> str:
+    if not text:
+        return text
+    # str.translate looks up every character of non-ASCII text in the table,
+    # which is slow for CJK text, so only runs matched by pattern are translated
+    if remove_space:
+        return _PATTERN_WITHOUT_SPACE.sub(_translate_without_space, text)
+    return _PATTERN.sub(_translate, text)
@@ -1,11 +1,19 @@
 import os
 import logging
+import functools
 from typing import List
 
 # Get logger
 logger = logging.getLogger(__name__)
 
 
+# reduced dimensions of embedding model, e.g. 256 or 1024 of
+# text-embedding-3-large, None for full dimensions
+def embedding_dimensions() -> int:
+    dimensions = os.environ.get('OPENAI_EMBEDDING_DIMENSIONS')
+    return int(dimensions) if dimensions else None
+
+
 # embedding function
 def embedder():
     from langchain_openai import OpenAIEmbeddings, AzureOpenAIEmbeddings
@@ -16,6 +24,7 @@ def embedder():
             f'Creating OpenAIEmbeddings with model {os.environ.get("OPENAI_EMBEDDING_MODEL")}')
         return OpenAIEmbeddings(
             model=os.environ.get('OPENAI_EMBEDDING_MODEL'),
+            dimensions=embedding_dimensions(),
             retry_min_seconds=60,
             retry_max_seconds=600,
             max_retries=10)
@@ -26,6 +35,7 @@ def embedder():
         return AzureOpenAIEmbeddings(
             azure_deployment=os.environ.get('AZURE_EMBEDDING_DEPLOYMENT'),
             model=os.environ.get('OPENAI_EMBEDDING_MODEL'),
+            dimensions=embedding_dimensions(),
             azure_endpoint=os.environ.get('AZURE_OPENAI_ENDPOINT'),
             openai_api_type=os.environ.get('OPENAI_API_TYPE'),
             api_key=os.environ.get('OPENAI_API_KEY'),
@@ -33,27 +43,68 @@ def embedder():
             chunk_size=1)
 
 
-# split documents into chunks function
+# embedding function with a persistent cache of embeddings
+def cached_embedder():
+    from util.embedding_cache import EmbeddingCache, CachedEmbeddings
+
+    cache_filepath = os.environ.get(
+        'EMBEDDINGS_CACHE_FILEPATH', 'assets/cache/embeddings.sqlite3')
+    logger.debug(f'Using embedding cache {cache_filepath}')
+    return CachedEmbeddings(
+        embedder(),
+        EmbeddingCache(cache_filepath),
+        model=os.environ.get('OPENAI_EMBEDDING_MODEL'),
+        dimensions=embedding_dimensions())
+
+
+# embedding function of queries, recently used queries are kept in memory,
+# and every query is kept in a persistent cache, so a repeated query skips
+# a round trip to the API
+@functools.cache
+def cached_query_embedder():
+    from util.embedding_cache import EmbeddingCache, CachedEmbeddings
+
+    cache_filepath = os.environ.get(
+        'QUERY_EMBEDDINGS_CACHE_FILEPATH', 'assets/cache/query_embeddings.sqlite3')
+    logger.debug(f'Using query embedding cache {cache_filepath}')
+    return CachedEmbeddings(
+        embedder(),
+        EmbeddingCache(cache_filepath),
+        model=os.environ.get('OPENAI_EMBEDDING_MODEL'),
+        dimensions=embedding_dimensions(),
+        memory_size=int(os.environ.get('QUERY_EMBEDDINGS_CACHE_SIZE', 1024)))
+
+
+# split documents into chunks function, chunk size and overlap are in tokens
+# of embedding model
 def text_splitter(
         documents,
-        chunk_size: int = 900,
+        chunk_size: int = 512,
         chunk_overlap: int = 0,
         separators: List[str] = None,):
-    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    return _text_splitter(
+        chunk_size,
+        chunk_overlap,
+        tuple(separators or ["\n\n", "\n", "。"])).split_documents(documents)
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        # separators=["\n\n", "\r\n", "\r", "\n", " ", "。", "　"],
-        separators=separators,
-        is_separator_regex=True,
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap)
-    chunks = text_splitter.split_documents(documents)
 
-    return chunks
+# splitter with precompiled pattern, created once for same arguments
+@functools.lru_cache(maxsize=8)
+def _text_splitter(
+        chunk_size: int,
+        chunk_overlap: int,
+        separators: tuple):
+    from util.splitter import CJKTextSplitter
+
+    return CJKTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=list(separators))
 
 
-# token and cost estimation in USD function
-def calculate_embedding_cost(documents) -> (int, float):
+# tokenizer of embedding model, loaded once
+@functools.cache
+def embedding_encoding():
     import tiktoken
 
     model_name = os.environ.get('OPENAI_EMBEDDING_MODEL')
@@ -68,9 +119,83 @@ def calculate_embedding_cost(documents) -> (int, float):
     encoding_name = model_encoding.get(model_name, None)
     # get encoding
     if encoding_name is None:
-        enc = tiktoken.encoding_for_model(model_name=model_name)
-    else:
-        enc = tiktoken.get_encoding(encoding_name)
+        return tiktoken.encoding_for_model(model_name=model_name)
+    return tiktoken.get_encoding(encoding_name)
+
+
+# persistent cache of token counts, shared in process
+@functools.cache
+def token_count_cache():
+    from util.token_cache import TokenCountCache
+
+    cache_filepath = os.environ.get(
+        'TOKEN_COUNTS_CACHE_FILEPATH', 'assets/cache/token_counts.sqlite3')
+    logger.debug(f'Using token count cache {cache_filepath}')
+    return TokenCountCache(cache_filepath)
+
+
+# persistent cache of query variants generated by LLM, shared in process,
+# None if disabled
+@functools.cache
+def query_variant_cache():
+    from util.variant_cache import QueryVariantCache
+
+    max_entries = int(os.environ.get('QUERY_VARIANTS_CACHE_SIZE', 10000))
+    if max_entries <= 0:
+        return None
+    cache_filepath = os.environ.get(
+        'QUERY_VARIANTS_CACHE_FILEPATH', 'assets/cache/query_variants.sqlite3')
+    logger.debug(f'Using query variant cache {cache_filepath}')
+    return QueryVariantCache(
+        cache_filepath,
+        ttl=float(os.environ.get('QUERY_VARIANTS_CACHE_TTL', 7 * 24 * 3600)),
+        max_entries=max_entries)
+
+
+# semantic cache of answers of retrieval QA, shared in process, None if
+# disabled, which is the default as questions of different articles or laws
+# may still be similar
+@functools.cache
+def answer_cache():
+    from util.answer_cache import AnswerCache
+
+    threshold = float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0))
+    if threshold <= 0:
+        return None
+    cache_filepath = os.environ.get(
+        'ANSWER_CACHE_FILEPATH', 'assets/cache/answers.sqlite3')
+    logger.debug(f'Using answer cache {cache_filepath}')
+    return AnswerCache(
+        cache_filepath,
+        threshold=threshold,
+        max_entries=int(os.environ.get('ANSWER_CACHE_SIZE', 1000)))
+
+
+# count tokens of each text by tokenizer of embedding model, cached counts
+# are reused and missing texts are tokenized in parallel threads
+def count_tokens(texts: List[str]) -> List[int]:
+    if not texts:
+        return []
+    enc = embedding_encoding()
+    cache = token_count_cache()
+    keys = [cache.key(enc.name, text) for text in texts]
+    found = cache.get_many(keys)
+    missing = [i for i, key in enumerate(keys) if key not in found]
+    if missing:
+        counts = [
+            len(tokens) for tokens in enc.encode_ordinary_batch(
+                [texts[i] for i in missing],
+                num_threads=int(os.environ.get('TOKENIZER_THREADS', os.cpu_count() or 1)))]
+        computed = {keys[i]: count for i, count in zip(missing, counts)}
+        cache.put_many(computed)
+        found.update(computed)
+    return [found[key] for key in keys]
+
+
+# token and cost estimation in USD function, token counts are computed
+# once and reused to plan embedding batches
+def calculate_embedding_cost(token_counts: List[int]) -> (int, float):
+    model_name = os.environ.get('OPENAI_EMBEDDING_MODEL')
 
     # a map to price for different models, in dollars per 1000 tokens
     model_price = {
@@ -81,10 +206,9 @@ def calculate_embedding_cost(documents) -> (int, float):
     # set default price to 0.02
     price = model_price.get(model_name, 0.02)
     logger.info(
-        f'Using model {model_name}, encoding {enc.name}, price ${price:.5f} per 1000 tokens')
+        f'Using model {model_name}, encoding {embedding_encoding().name}, price ${price:.5f} per 1000 tokens')
 
-    total_tokens = sum([len(enc.encode(page.page_content))
-                       for page in documents])
+    total_tokens = sum(token_counts)
 
     return total_tokens, total_tokens / 1000 * price
 
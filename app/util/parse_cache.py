@@ -0,0 +1,81 @@
+# A persistent cache of text extracted from files, keyed by file path, size,
+# mtime and content hash, so unchanged files are never parsed twice
+
+import os
+import hashlib
+import logging
+import sqlite3
+import threading
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+# hash of file content, read in blocks
+def file_hash(filepath: str) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # wait for lock, in case the cache is shared by processes
+        self.conn = sqlite3.connect(filepath, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS parsed ('
+            'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+            'sha256 TEXT NOT NULL, text TEXT NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS parsed_sha256 ON parsed (sha256)')
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    # return cached text and content hash of file, text is None if missing
+    # size and mtime are checked first, content is hashed only if they
+    # changed, e.g. a copied or touched file with same content
+    def get(self, filepath: str) -> tuple:
+        stat = os.stat(filepath)
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime_ns, sha256, text FROM parsed WHERE path = ?',
+                (filepath,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[3], row[2]
+
+        sha256 = file_hash(filepath)
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT text FROM parsed WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone()
+        if row is None:
+            return None, sha256
+        # same content, refresh path, size and mtime
+        self.put(filepath, sha256, row[0])
+        return row[0], sha256
+
+    # content hash of file, without reading cached text
+    def hash(self, filepath: str) -> str:
+        stat = os.stat(filepath)
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime_ns, sha256 FROM parsed WHERE path = ?',
+                (filepath,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        return file_hash(filepath)
+
+    def put(self, filepath: str, sha256: str, text: str):
+        stat = os.stat(filepath)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO parsed (path, size, mtime_ns, sha256, text) VALUES (?, ?, ?, ?, ?)',
+                (filepath, stat.st_size, stat.st_mtime_ns, sha256, text))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM parsed').fetchone()[0]
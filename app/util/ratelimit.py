@@ -0,0 +1,39 @@
+# Rate limiters for provider budgets, e.g. tokens and requests per minute
+
+import time
+import asyncio
+
+
+# A token bucket refilled continuously at a rate per minute,
+# acquire waits until enough tokens are in the bucket
+class TokenBucket:
+    def __init__(
+            self,
+            per_minute: float,
+            capacity: float = None):
+        # no limit if rate is not configured
+        self.unlimited = not per_minute
+        self.rate = (per_minute or 0) / 60
+        self.capacity = capacity or per_minute or 0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        if self.unlimited:
+            return
+        # a request larger than the bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        # acquire in order, so large requests are not starved by small ones
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
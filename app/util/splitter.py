@@ -0,0 +1,110 @@
+# A splitter for CJK text, chunks are sized by estimated tokens of the
+# embedding model instead of characters. Text is cut at separators by
+# precompiled patterns, only oversized segments are cut again by finer
+# separators, and segments are merged up to chunk size in one pass, with
+# trailing segments up to chunk overlap repeated in next chunk
+
+import re
+import math
+from typing import Callable, Iterator, List
+
+
+class CJKTextSplitter:
+    def __init__(
+            self,
+            chunk_size: int = 512,
+            chunk_overlap: int = 64,
+            separators: List[str] = ["\n\n", "\n", "。", "？", "："],
+            encode: Callable[[str], list] = None):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        # separators are regular expressions from coarse to fine, a pattern
+        # of each separator is compiled once, and separator is kept at end
+        # of segment, e.g. a sentence keeps its full stop
+        self.patterns = [
+            re.compile(f'.*?(?:{separator})|.+', re.DOTALL) for separator in separators]
+        self.encode = encode
+        self.costs = None
+
+    # costs of characters of text in quarter tokens, as bytes. BPE over
+    # every segment is several times slower than splitting, CJK characters
+    # are mostly one token each, so a character costs its own token count,
+    # and ASCII costs a quarter token as English words
+    def _costs(self, text: str) -> bytes:
+        if self.costs is None:
+            self.costs = _CharacterCosts(self.encode)
+        return text.translate(self.costs).encode('latin-1')
+
+    # segments of text between start and end with estimated tokens, a
+    # segment over chunk size is cut again by next separator, and by
+    # characters after the last separator
+    def _segments(self, text: str, costs: bytes, start: int, end: int, level: int = 0) -> Iterator[tuple]:
+        if level == len(self.patterns):
+            length = _tokens(costs, start, end)
+            step = math.ceil((end - start) / math.ceil(length / self.chunk_size))
+            for i in range(start, end, step):
+                j = min(i + step, end)
+                yield text[i:j], _tokens(costs, i, j)
+            return
+        for match in self.patterns[level].finditer(text, start, end):
+            i, j = match.span()
+            length = _tokens(costs, i, j)
+            if length <= self.chunk_size:
+                yield text[i:j], length
+            else:
+                yield from self._segments(text, costs, i, j, level + 1)
+
+    def split_text(self, text: str) -> List[str]:
+        # most law articles fit in one chunk, a token has at least one
+        # byte, so short text is not estimated at all
+        if len(text) * 3 <= self.chunk_size or len(text.encode('utf-8')) <= self.chunk_size:
+            return [text.strip()] if text.strip() else []
+        costs = self._costs(text)
+        if _tokens(costs, 0, len(text)) <= self.chunk_size:
+            return [text.strip()] if text.strip() else []
+
+        segments, lengths = zip(*self._segments(text, costs, 0, len(text)))
+        chunks = []
+        total = 0
+        start = 0
+        for i, length in enumerate(lengths):
+            if total + length > self.chunk_size and i > start:
+                chunks.append(''.join(segments[start:i]))
+                # keep trailing segments within overlap for next chunk
+                while start < i and (total > self.chunk_overlap or total + length > self.chunk_size):
+                    total -= lengths[start]
+                    start += 1
+            total += length
+        if start < len(segments):
+            chunks.append(''.join(segments[start:]))
+        return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+    def split_documents(self, documents: list) -> list:
+        from langchain_core.documents import Document
+
+        return [
+            Document(page_content=chunk, metadata=dict(document.metadata))
+            for document in documents
+            for chunk in self.split_text(document.page_content)]
+
+
+# estimated tokens of characters between start and end
+def _tokens(costs: bytes, start: int, end: int) -> int:
+    return -(-sum(costs[start:end]) // 4)
+
+
+# translation table of characters to their costs in quarter tokens, ASCII
+# costs a quarter, and other characters are tokenized once when first seen
+class _CharacterCosts(dict):
+    def __init__(self, encode: Callable[[str], list] = None):
+        super().__init__((code, '\x01') for code in range(0x80))
+        if encode is None:
+            from util.openai import embedding_encoding
+
+            encode = embedding_encoding().encode_ordinary
+        self.encode = encode
+
+    def __missing__(self, code: int) -> str:
+        cost = chr(min(len(self.encode(chr(code))) * 4, 0xff))
+        self[code] = cost
+        return cost
@@ -0,0 +1,58 @@
+# A persistent cache of token counts, keyed by encoding name and hash of
+# text, so chunks are tokenized once and their counts are reused by cost
+# estimation, batch planning and rate budgets of later runs
+
+import os
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import List
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+class TokenCountCache:
+    # maximum number of variables in one SQLite statement
+    BATCH_SIZE = 500
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # wait for lock, in case the cache is shared by processes
+        self.conn = sqlite3.connect(filepath, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS token_counts (key TEXT PRIMARY KEY, tokens INTEGER NOT NULL)')
+        self.conn.commit()
+        # tokenization runs in threads of pipeline
+        self.lock = threading.Lock()
+
+    # cache key of text tokenized by encoding
+    @staticmethod
+    def key(encoding: str, text: str) -> str:
+        return hashlib.sha256(f'{encoding}\x00{text}'.encode('utf-8')).hexdigest()
+
+    # return cached token counts of keys, missing keys are not in result
+    def get_many(self, keys: List[str]) -> dict:
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), self.BATCH_SIZE):
+                batch = keys[i:i + self.BATCH_SIZE]
+                rows = self.conn.execute(
+                    f'SELECT key, tokens FROM token_counts WHERE key IN ({",".join("?" * len(batch))})',
+                    batch)
+                found.update(rows)
+        return found
+
+    def put_many(self, items: dict):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO token_counts (key, tokens) VALUES (?, ?)',
+                items.items())
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM token_counts').fetchone()[0]
@@ -1,18 +1,24 @@
-# chunker function
-# calculate batch size based on total documents
-# batch size is the number of documents to be processed in one batch
-def chunker(documents: list[any]) -> (list[list[any]], int):
-    if len(documents) > 10000:
-        batch_size = int(len(documents) / 10000)
-    elif len(documents) > 1000:
-        batch_size = int(len(documents) / 1000)
-    elif len(documents) > 100:
-        batch_size = int(len(documents) / 100)
-    else:
-        batch_size = len(documents)
-    return chunk_by_batch_size(
-        documents=documents,
-        batch_size=batch_size), batch_size
+from typing import Iterable, Iterator
+
+
+# pack documents by token count into batches
+# a batch is sent in one embedding request, so it is packed up to
+# max inputs and max tokens per request of the provider
+# yield each batch with its total tokens, documents are consumed lazily
+def iter_batches(
+        documents: Iterable[tuple[any, int]],
+        max_inputs: int = 2048,
+        max_tokens: int = 300000) -> Iterator[tuple[list[any], int]]:
+    batch, tokens = [], 0
+    for document, count in documents:
+        # a document over max tokens still gets a batch of its own
+        if batch and (len(batch) >= max_inputs or tokens + count > max_tokens):
+            yield batch, tokens
+            batch, tokens = [], 0
+        batch.append(document)
+        tokens += count
+    if batch:
+        yield batch, tokens
 
 
 def chunk_by_batch_size(documents: list[any], batch_size: int) -> list[list[any]]:
@@ -0,0 +1,88 @@
+# A persistent cache of query variants generated by LLM for multi-query
+# retrieval, keyed by normalized question, target collection and prompt
+# version, entries expire after TTL, and least recently used entries are
+# evicted beyond max entries
+
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import List
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+# version of a prompt, changed whenever template or model changes
+def prompt_version(template: str, model: str) -> str:
+    return hashlib.sha256(f'{model}\x00{template}'.encode('utf-8')).hexdigest()[:12]
+
+
+class QueryVariantCache:
+    def __init__(
+            self,
+            filepath: str,
+            ttl: float = 7 * 24 * 3600,
+            max_entries: int = 10000):
+        self.filepath = filepath
+        self.ttl = ttl
+        self.max_entries = max_entries
+        if os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # wait for lock, in case the cache is shared by processes
+        self.conn = sqlite3.connect(filepath, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS variants ('
+            'key TEXT PRIMARY KEY, queries TEXT NOT NULL, '
+            'created REAL NOT NULL, accessed REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS variants_accessed ON variants (accessed)')
+        self.conn.commit()
+        # sessions of the app retrieve in threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # cache key of question of collection generated by prompt version
+    @staticmethod
+    def key(question: str, collection_name: str, version: str) -> str:
+        return hashlib.sha256(
+            f'{version}\x00{collection_name}\x00{question}'.encode('utf-8')).hexdigest()
+
+    # return cached variants of key, None if missing or expired
+    def get(self, key: str) -> List[str]:
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                'SELECT queries, created FROM variants WHERE key = ?', (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.conn.execute('UPDATE variants SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    # store variants, and evict expired and least recently used entries
+    def put(self, key: str, queries: List[str]):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO variants (key, queries, created, accessed) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(queries, ensure_ascii=False), now, now))
+            self.conn.execute('DELETE FROM variants WHERE created < ?', (now - self.ttl,))
+            self.conn.execute(
+                'DELETE FROM variants WHERE key IN ('
+                'SELECT key FROM variants ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+
+    # ratio of questions found in cache
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM variants').fetchone()[0]